@@ -1,45 +1,146 @@
 #%% required libraries
-from fastapi import FastAPI, Depends
+from fastapi import FastAPI, Depends, Header, Request, HTTPException
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel, Field
-from typing import Literal
-from catboost import CatBoostRegressor
-import pandas as pd
 from steps.predict import Predictor
+from steps.schemas import Insured, BatchInsured, PredictionResponse, BatchPredictionResponse
+from steps.batcher import MicroBatcher
+from steps.cache import QuoteCache
+from steps.models import ModelStore, memory_usage
+from steps.metrics import Counter, Gauge, Histogram, Registry, MetricsMiddleware, StackSampler
+from contextlib import contextmanager
+import hmac
+import os
+import time
 import uvicorn
+import yaml
+
+#%% load the config file
+with open('config.yml', 'r') as file:
+    config = yaml.safe_load(file)
+max_batch_size = config['api']['max_batch_size']
+micro_batch = config['api']['micro_batch']
+quote_cache = QuoteCache(config['quote_cache']['max_entries']) if config['quote_cache']['enabled'] else None
+metrics_config = config['metrics']
+serving = config['serving']
+admin_token = os.environ.get(config['admin']['token_env'], '')
 
 app = FastAPI()
 
-# Input schema for the insured person
-class Insured(BaseModel):
-    VehPower: int = Field(title='Vehicle Power', description='Vehicle power in CV', ge=1, le=20, default=5)
-    VehAge: int = Field(title='Vehicle Age', description='Vehicle age in years', ge=0, le=120, default=1)
-    DrivAge: int = Field(title='Driver Age', description='Driver age in years', ge=18, le=120, default=35)
-    Density: int = Field(title='Density', description='Density of inhabitants per km2', gt=0, le=30000, default=100)
-    BonusMalus: int = Field(title='Bonus Malus', description='Bonus Malus', ge=50, le=230, default=100)
-    VehBrand: Literal['B12', 'B3', 'B2', 'B5', 'B4', 'B6', 'B10', 'B1', 'B13', 'B11', 'B14'] = Field(title='Vehicle Brand', description='Vehicle brand as per allowed values')
-    VehGas: Literal['Regular', 'Diesel'] = Field(title='Vehicle Gas', description='Vehicle gas as per allowed values')
-    Region: Literal['R72', 'R91', 'R52', 'R11', 'R94', 'R93', 'R31', 'R82', 'R22', 'R21', 'R42', 'R54', 'R73', 'R41', 'R26', 'R25', 'R24', 'R53', 'R83', 'R23', 'R74', 'R43'] = Field(title='Region', description='Region code as per allowed values')
-    Area: Literal['A', 'B', 'C', 'D', 'E', 'F', 'G'] = Field(title='Area', description='Area code as per allowed values')
-
-# Output schema for prediction response
-class PredictionResponse(BaseModel):
-    Frequency: float
-    Severity: float
-    Pure_Premium: float
-
-# Load models as a startup event
+#%% Prometheus metrics
+registry = Registry()
+http_requests = registry.register(Counter('http_requests_total', 'HTTP requests by path and status', ('path', 'status')))
+http_latency = registry.register(Histogram('http_request_duration_seconds', 'HTTP request latency by path', ('path',)))
+in_flight = registry.register(Gauge('http_requests_in_flight', 'HTTP requests being served'))
+stage_seconds = registry.register(Histogram('quote_stage_duration_seconds', 'Time spent in each scoring stage (validation, features, create_pool, inference, serialization)', ('stage',)))
+quotes_scored = registry.register(Counter('quotes_total', 'Insureds quoted by endpoint', ('endpoint',)))
+model_load_seconds = registry.register(Gauge('model_load_duration_seconds', 'Time taken to load each model at startup', ('model',)))
+cache_requests = registry.register(Counter('quote_cache_requests_total', 'Quote cache lookups by result', ('result',)))
+cache_entries = registry.register(Gauge('quote_cache_entries', 'Quotes held in the cache'))
+micro_batches = registry.register(Counter('micro_batches_total', 'Micro batches scored'))
+model_reloads = registry.register(Counter('model_reloads_total', 'Model reloads by result', ('result',)))
+memory_bytes = registry.register(Gauge('process_memory_bytes', 'Memory of this worker (rss, pss, shared, private)', ('kind',)))
+profiler = StackSampler(metrics_config['profiling']['interval_ms'])
+
+
+def observe_stage(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage)
+
+
+# Times the handler body: validation is the time from the request arrival to the handler,
+# serialization is measured by the middleware from the handler end to the response start
+@contextmanager
+def handler_timer(request: Request):
+    start = time.perf_counter()
+    if 'metrics_start' in request.scope.get('state', {}):
+        stage_seconds.observe(start - request.scope['state']['metrics_start'], 'validation')
+    try:
+        yield
+    finally:
+        request.scope.setdefault('state', {})['handler_end'] = time.perf_counter()
+
+# Admin and profiler endpoints require the token of the environment variable admin.token_env in the X-Admin-Token
+# header, and do not exist (404) when it is not set
+def require_admin(x_admin_token: str = Header(default='')):
+    if not admin_token:
+        raise HTTPException(status_code=404, detail='Not Found')
+    if not hmac.compare_digest(x_admin_token.encode(), admin_token.encode()):
+        raise HTTPException(status_code=401, detail='Invalid or missing admin token')
+
+# Input schema for a batch of insured persons (schemas in steps/schemas.py)
+class BatchRequest(BaseModel):
+    insureds: list[BatchInsured] = Field(title='Insureds', description='Insured persons to quote', min_length=1, max_length=max_batch_size)
+
+# Models are loaded at import when preloading, so that workers forked by gunicorn --preload
+# share them copy on write; store.current is swapped atomically on reload (see steps/models.py)
+store = ModelStore('config.yml', serving['generation_file'])
+if serving['preload']:
+    store.load()
+
+def set_model_load_seconds():
+    for model_type, seconds in store.current.load_seconds.items():
+        model_load_seconds.set(model_type, value=seconds)
+
+# Load models as a startup event (if not preloaded) and watch the model files
 @app.on_event("startup")
 def load_models():
-    global model_freq, model_sev
-    model_freq = CatBoostRegressor()
-    model_freq.load_model('models/frequency_model.cbm')
-    model_sev = CatBoostRegressor()
-    model_sev.load_model('models/severity_model.cbm')
+    if store.current is None:
+        store.load()
+    elif store.read_generation() != store.generation:
+        # a worker forked after a reload starts from the preloaded models: it catches up at once
+        store.reload()
+    set_model_load_seconds()
+    # the generation file is always watched, the config and model files with serving.watch
+    store.watch(serving['watch']['interval_s'], files=serving['watch']['enabled'])
 
+@app.on_event("shutdown")
+def stop_watcher():
+    store.stop()
 
-# Dependency for loading the Predictor
-def get_predictor(model, type_):
-    return Predictor(model, type_)
+
+# Dependency for loading both Predictors from the same model set
+def get_predictors() -> tuple[Predictor, Predictor]:
+    models = store.current
+    stage_hook = observe_stage if metrics_config['enabled'] else None
+    return (Predictor(models.frequency, 'frequency', cache=quote_cache, model_version=models.version, stage_hook=stage_hook),
+            Predictor(models.severity, 'severity', cache=quote_cache, model_version=models.version, stage_hook=stage_hook))
+
+
+# Scores a list of insured records with one call per model (used by the micro batcher
+# on records already looked up in the quote cache)
+def score_insureds(records: list[dict]) -> list[tuple[float, float, float]]:
+    predictor_freq, predictor_sev = get_predictors()
+    pred_freq = predictor_freq.predict_cached(records, lookup=False)
+    pred_sev = predictor_sev.predict_cached(records, lookup=False)
+    pure_premium = pred_freq * pred_sev
+    return list(zip(pred_freq.tolist(), pred_sev.tolist(), pure_premium.tolist()))
+
+
+# Start the micro batching dispatcher for the single quote endpoint
+batcher = None
+
+@app.on_event("startup")
+async def start_batcher():
+    global batcher
+    if micro_batch['enabled']:
+        batcher = MicroBatcher(score_insureds, window_ms=micro_batch['window_ms'], max_batch_size=micro_batch['max_batch_size'])
+        await batcher.start()
+
+@app.on_event("shutdown")
+async def stop_batcher():
+    if batcher is not None:
+        await batcher.stop()
+
+
+# Start the stack sampler if profiling is switched on in the config
+@app.on_event("startup")
+def start_profiler():
+    if metrics_config['profiling']['enabled']:
+        profiler.start()
+
+@app.on_event("shutdown")
+def stop_profiler():
+    profiler.stop()
 
 
 @app.get("/", response_model=dict)
@@ -50,21 +151,112 @@ async def read_root():
 @app.post("/predict/", response_model=PredictionResponse)
 async def predict(
     insured: Insured,
-    predictor_freq: Predictor = Depends(lambda: get_predictor(model_freq, 'frequency')),
-    predictor_sev: Predictor = Depends(lambda: get_predictor(model_sev, 'severity'))
+    request: Request,
+    predictors: tuple[Predictor, Predictor] = Depends(get_predictors)
 ):
-    # Convert insured data to DataFrame
-    df_insured = pd.DataFrame([insured.dict()])
-    df_insured['log_exposure'] = 0.0
-    df_insured['ClaimNb'] = 1
-    
-    # Perform predictions
-    pred_freq = predictor_freq.predict(df_insured)[0]
-    pred_sev = predictor_sev.predict(df_insured)[0]
-    pure_premium = pred_freq * pred_sev
-    
-    # Create response
-    return PredictionResponse(Frequency=pred_freq, Severity=pred_sev, Pure_Premium=pure_premium)
+    with handler_timer(request):
+        predictor_freq, predictor_sev = predictors
+        quotes_scored.inc('predict')
+        insured_data = insured.dict()
+
+        # Answer repeated quotes from the cache
+        pred_freq = predictor_freq.cached(insured_data)
+        pred_sev = predictor_sev.cached(insured_data)
+        if pred_freq is not None and pred_sev is not None:
+            return PredictionResponse(Frequency=pred_freq, Severity=pred_sev, Pure_Premium=pred_freq * pred_sev)
+
+        # Coalesce with concurrent requests and score off the event loop
+        if batcher is not None:
+            pred_freq, pred_sev, pure_premium = await batcher.submit(insured_data)
+            return PredictionResponse(Frequency=pred_freq, Severity=pred_sev, Pure_Premium=pure_premium)
+
+        # Perform predictions straight from the insured data (unit exposure)
+        pred_freq = predictor_freq.predict_cached(insured_data, lookup=False)[0]
+        pred_sev = predictor_sev.predict_cached(insured_data, lookup=False)[0]
+        pure_premium = pred_freq * pred_sev
+
+        # Create response
+        return PredictionResponse(Frequency=pred_freq, Severity=pred_sev, Pure_Premium=pure_premium)
+
+# Batch prediction endpoint: one prediction call per model for the whole batch
+# declared sync so FastAPI runs the CPU-bound scoring in its threadpool
+@app.post("/predict/batch", response_model=BatchPredictionResponse)
+def predict_batch(
+    batch: BatchRequest,
+    request: Request,
+    predictors: tuple[Predictor, Predictor] = Depends(get_predictors)
+):
+    with handler_timer(request):
+        predictor_freq, predictor_sev = predictors
+        quotes_scored.inc('predict_batch', amount=len(batch.insureds))
+        # Perform predictions straight from the insured data, with exposure as baseline
+        records = [insured.dict() for insured in batch.insureds]
+        pred_freq = predictor_freq.predict_cached(records)
+        pred_sev = predictor_sev.predict_cached(records)
+        pure_premium = pred_freq * pred_sev
+
+        # Create response
+        return BatchPredictionResponse(Frequency=pred_freq.tolist(), Severity=pred_sev.tolist(), Pure_Premium=pure_premium.tolist())
+
+# Observed micro batch sizes and quote cache counters
+@app.get("/predict/stats", response_model=dict)
+async def predict_stats():
+    return {
+        'micro_batch': {'enabled': False} if batcher is None else {'enabled': True, **batcher.stats()},
+        'quote_cache': {'enabled': False} if quote_cache is None else {'enabled': True, 'model_version': store.current.version, **quote_cache.stats()},
+    }
+
+# Prometheus metrics, with the quote cache and micro batcher counters read at scrape time
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    if quote_cache is not None:
+        stats = quote_cache.stats()
+        cache_requests.set('hit', value=stats['hits'])
+        cache_requests.set('miss', value=stats['misses'])
+        cache_entries.set(value=stats['entries'])
+    if batcher is not None:
+        micro_batches.set(value=batcher.stats()['batches'])
+    for result, count in store.reloads.items():
+        model_reloads.set(result, value=count)
+    for kind, value in memory_usage().items():
+        memory_bytes.set(kind.removesuffix('_bytes'), value=value)
+    return registry.render()
+
+# Hot reload: loads and validates both models from the paths in config.yml, then swaps them
+# in one step in the worker serving the request, which then bumps the generation file: the
+# other workers reload within serving.watch.interval_s; the response reports the worker
+# memory before and after
+@app.post("/admin/reload", response_model=dict, dependencies=[Depends(require_admin)])
+def reload_models():
+    try:
+        result = store.publish()
+    except Exception as error:
+        raise HTTPException(status_code=500, detail=f'Reload failed, still serving model version {store.current.version}: {error}')
+    set_model_load_seconds()
+    return result
+
+@app.get("/admin/memory", response_model=dict, dependencies=[Depends(require_admin)])
+async def worker_memory():
+    return {'pid': os.getpid(), 'model_version': store.current.version, 'generation': store.generation, **memory_usage()}
+
+# Sampling profiler: switched on and off at runtime, stacks in collapsed format for flame graphs
+@app.post("/profile/start", response_model=dict, dependencies=[Depends(require_admin)])
+async def profile_start():
+    profiler.start()
+    return {'running': profiler.running, 'interval_ms': profiler.interval * 1000}
+
+@app.post("/profile/stop", response_model=dict, dependencies=[Depends(require_admin)])
+async def profile_stop():
+    profiler.stop()
+    return {'running': profiler.running, 'samples': profiler.samples}
+
+@app.get("/profile", response_class=PlainTextResponse, dependencies=[Depends(require_admin)])
+async def profile():
+    return profiler.collapsed()
+
+if metrics_config['enabled']:
+    app.add_middleware(MetricsMiddleware, requests=http_requests, latency=http_latency, in_flight=in_flight,
+                       stages=stage_seconds, paths={route.path for route in app.routes})
 
 #%% core to run the FastAPI app 
 if __name__ == "__main__":
@@ -0,0 +1,79 @@
+#%% libraries
+import argparse
+import asyncio
+import time
+import numpy as np
+import yaml
+from catboost import CatBoostRegressor
+from steps.predict import Predictor
+from steps.metrics import Counter, Gauge, Histogram, MetricsMiddleware
+
+#%% overhead of the /metrics instrumentation
+# times the work added to each quote (stage hook and ASGI middleware) in tight loops and compares
+# it with the latency of a single quote; end-to-end A/B timings of a ~0.5ms call are dominated by
+# noise, the cost of the instrumentation itself is not; run from the repository root:
+# python -m benchmarks.metrics_overhead
+insured = {'VehPower': 5, 'VehAge': 1, 'DrivAge': 35, 'Density': 100, 'BonusMalus': 100,
+           'VehBrand': 'B12', 'VehGas': 'Regular', 'Region': 'R11', 'Area': 'A'}
+
+def per_call_us(fn, n: int) -> float:
+    # mean wall-clock time of fn over n calls, in microseconds
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - start) / n * 1e6
+
+def bench_quote(model_path: str, n: int) -> float:
+    # median latency of a single quote on the fast path, without instrumentation
+    predictor = Predictor(CatBoostRegressor().load_model(model_path), 'frequency')
+    return float(np.median([per_call_us(lambda: predictor.predict_fast(insured), 1) for _ in range(n)]))
+
+def bench_stage_hook(n: int) -> float:
+    # the three timings Predictor.predict_fast records per call, with and without a hook
+    stages = Histogram('bench_stage_seconds', 'benchmark', ('stage',))
+    plain = Predictor(None, 'frequency')
+    hooked = Predictor(None, 'frequency', stage_hook=lambda stage, seconds: stages.observe(seconds, stage))
+
+    def observe_stages(predictor):
+        start = predictor._observe('features', time.perf_counter())
+        start = predictor._observe('create_pool', start)
+        predictor._observe('inference', start)
+
+    return per_call_us(lambda: observe_stages(hooked), n) - per_call_us(lambda: observe_stages(plain), n)
+
+def bench_middleware(n: int) -> float:
+    async def empty_app(scope, receive, send):
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def noop_send(message):
+        return None
+
+    middleware = MetricsMiddleware(empty_app, requests=Counter('r', 'r', ('path', 'status')), latency=Histogram('l', 'l', ('path',)),
+                                   in_flight=Gauge('f', 'f'), stages=Histogram('s', 's', ('stage',)), paths={'/predict/'})
+
+    async def run(app) -> float:
+        start = time.perf_counter()
+        for _ in range(n):
+            await app({'type': 'http', 'path': '/predict/'}, None, noop_send)
+        return (time.perf_counter() - start) / n * 1e6
+
+    return asyncio.run(run(middleware)) - asyncio.run(run(empty_app))
+
+#%% main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Overhead of the Prometheus instrumentation of the API')
+    parser.add_argument('--n', type=int, default=20_000, help='calls per measurement')
+    args = parser.parse_args()
+    with open('config.yml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    quote_us = bench_quote(config['models']['frequency'], min(args.n, 5_000))
+    histogram = Histogram('bench_seconds', 'benchmark', ('stage',))
+    observe_us = per_call_us(lambda: histogram.observe(0.001, 'inference'), args.n)
+    hook_us = bench_stage_hook(args.n)
+    middleware_us = bench_middleware(args.n)
+    print(f'single quote (predict_fast):   {quote_us:8.2f} us')
+    print(f'Histogram.observe:             {observe_us:8.2f} us')
+    print(f'stage hook per scoring call:   {hook_us:8.2f} us ({100 * hook_us / quote_us:.2f}% of a quote)')
+    print(f'MetricsMiddleware per request: {middleware_us:8.2f} us ({100 * middleware_us / quote_us:.2f}% of a quote)')
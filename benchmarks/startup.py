@@ -0,0 +1,73 @@
+#%% libraries
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+from datetime import datetime, timezone
+
+#%% cold start of the serving entry points
+# import time of the module in a fresh interpreter, time from process launch to readiness
+# and latency of the first and second quotes over HTTP, for serve.py and app.py; results can
+# be appended as json lines to track them across releases; run from the repository root:
+# python -m benchmarks.startup --output benchmarks/results/startup.jsonl
+insured = {'VehPower': 5, 'VehAge': 1, 'DrivAge': 35, 'Density': 100, 'BonusMalus': 100,
+           'VehBrand': 'B12', 'VehGas': 'Regular', 'Region': 'R11', 'Area': 'A'}
+# readiness url of each entry point (app.py has no readiness probe, its models load at import)
+entry_points = {'serve': '/ready', 'app': '/'}
+
+def import_seconds(module: str, repeats: int) -> float:
+    code = f'import time; start = time.perf_counter(); import {module}; print(time.perf_counter() - start)'
+    return statistics.median(float(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout)
+                             for _ in range(repeats))
+
+def post_seconds(url: str) -> float:
+    request = urllib.request.Request(url, data=json.dumps(insured).encode(), headers={'Content-Type': 'application/json'})
+    start = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+    return time.perf_counter() - start
+
+def cold_start(module: str, port: int) -> dict:
+    base = f'http://127.0.0.1:{port}'
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'uvicorn', f'{module}:app', '--port', str(port)],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                with urllib.request.urlopen(base + entry_points[module], timeout=5):
+                    break
+            except (urllib.error.URLError, ConnectionError):
+                if server.poll() is not None:
+                    raise RuntimeError(f'{module} exited during startup')
+                time.sleep(0.01)
+        ready_s = time.perf_counter() - start
+        first_s = post_seconds(f'{base}/predict/')
+        second_s = post_seconds(f'{base}/predict/')
+    finally:
+        server.terminate()
+        server.wait()
+    return {'ready_s': ready_s, 'first_quote_s': first_s, 'second_quote_s': second_s}
+
+#%% main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import time, time to ready and first quote latency of the serving entry points')
+    parser.add_argument('--repeats', type=int, default=5, help='fresh interpreters per import measurement')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--output', default=None, help='json lines file the results are appended to')
+    args = parser.parse_args()
+
+    results = {}
+    for module in entry_points:
+        results[module] = {'import_s': import_seconds(module, args.repeats), **cold_start(module, args.port)}
+        print(f'{module:>6}: import {results[module]["import_s"]:.3f}s, ready after {results[module]["ready_s"]:.3f}s, '
+              f'first quote {1000 * results[module]["first_quote_s"]:.1f}ms, second quote {1000 * results[module]["second_quote_s"]:.1f}ms')
+
+    if args.output:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+        with open(args.output, 'a') as file:
+            file.write(json.dumps({'timestamp': datetime.now(timezone.utc).isoformat(), 'commit': commit, 'results': results}) + '\n')
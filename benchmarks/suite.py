@@ -0,0 +1,174 @@
+#%% libraries
+import argparse
+import importlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+import numpy as np
+import yaml
+
+# the suite runs in a scratch workspace (data/, models/ and config.yml), with the repository
+# modules imported from their own folder
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository)
+
+#%% reproducible benchmark suite on a synthetic portfolio
+# synthetic data (synthetic.py) -> dataset.py splits -> ingestion, cleaning and training of both
+# models -> single and batch prediction latency percentiles -> API requests/s through an
+# in-process client, for serve.py and app.py; the results go to a json file that can be compared
+# with the one of another commit (--baseline); run from the repository root:
+# python -m benchmarks.suite --rows 200000 --output benchmark-results.json
+def percentiles(seconds: list) -> dict:
+    ms = 1000 * np.asarray(seconds)
+    return {'p50_ms': float(np.percentile(ms, 50)), 'p95_ms': float(np.percentile(ms, 95)), 'p99_ms': float(np.percentile(ms, 99))}
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+def bench_data(rows: int, seed: int) -> dict:
+    import dataset
+    import synthetic
+    _, generate_s = timed(lambda: synthetic.save_portfolio(dataset.data_file, rows, seed))
+    _, prepare_s = timed(dataset.main)
+    return {'generate_rows_per_s': rows / generate_s, 'prepare_rows_per_s': rows / prepare_s}
+
+def bench_ingestion() -> tuple[dict, tuple]:
+    from steps.ingest import Ingestion
+    from steps.clean import Cleaner
+    # cold: csv parsed and cached as parquet, warm: parquet cache read by a new instance
+    splits, cold_s = timed(lambda: Ingestion().load_freq())
+    splits, warm_s = timed(lambda: Ingestion().load_freq())
+    rows = sum(len(split) for split in splits)
+    cleaner = Cleaner()
+    _, clean_s = timed(lambda: [cleaner.clean(split, 'frequency') for split in splits])
+    results = {'ingest_cold_rows_per_s': rows / cold_s, 'ingest_warm_rows_per_s': rows / warm_s, 'clean_rows_per_s': rows / clean_s}
+    return results, splits
+
+def bench_training(splits: tuple, train_rows: int, config: dict) -> dict:
+    from steps.train import Trainer
+    from steps.compiled import export_model
+    train, valid, test = splits
+    train, valid = train.iloc[:train_rows], valid.iloc[:max(train_rows // 7, 1)]
+    results = {}
+    for model_type, target in (('frequency', 'ClaimNb'), ('severity', 'severity')):
+        data = [split.assign(severity=split['claims_cost'].div(split['ClaimNb']).where(split['ClaimNb'] > 0, 0))
+                for split in (train, valid, test)]
+        trainer = Trainer(target=target, train_data=data[0], val_data=data[1], test_data=data[2], model_type=model_type)
+        trainer.create_pools()
+        model, fit_s = timed(trainer.train_model)
+        results[f'{model_type}_train_s_per_1k_rows'] = 1000 * (trainer.timings['create_pools_s'] + fit_s) / len(train)
+        model.save_model(config['models'][model_type])
+        export_model(model, data[0].filter(items=trainer.numeric_features + trainer.cat_features), trainer.cat_features,
+                     config['models'][f'{model_type}_compiled'])
+    return results
+
+def bench_prediction(test, config: dict, quotes: int, batch_size: int, batches: int) -> dict:
+    from catboost import CatBoostRegressor
+    from steps.compiled import CompiledModel
+    from steps.predict import Predictor
+    # unit exposure, as quoted by the API
+    records = test.drop(columns='log_exposure').iloc[:max(quotes, batch_size)].assign(Exposure=1.0).to_dict('records')
+    results = {}
+    for backend in ('catboost', 'compiled'):
+        for model_type in ('frequency', 'severity'):
+            if backend == 'catboost':
+                model = CatBoostRegressor().load_model(config['models'][model_type])
+            else:
+                model = CompiledModel(config['models'][f'{model_type}_compiled'])
+            predictor = Predictor(model, model_type)
+            predictor.predict_fast(records[:batch_size])
+            single = [timed(lambda: predictor.predict_fast(record))[1] for record in records[:quotes]]
+            batch = [timed(lambda: predictor.predict_fast(records[:batch_size]))[1] for _ in range(batches)]
+            for name, value in percentiles(single).items():
+                results[f'{backend}_{model_type}_single_{name}'] = value
+            for name, value in percentiles(batch).items():
+                results[f'{backend}_{model_type}_batch{batch_size}_{name}'] = value
+    return results
+
+def bench_api(test, requests: int, batch_size: int) -> dict:
+    from fastapi.testclient import TestClient
+    from steps.predict import Predictor
+    predictor = Predictor(None, 'frequency')
+    # distinct quotes, so that app.py answers from the models and not from its quote cache
+    quotes = test.filter(items=predictor.numeric_features + predictor.cat_features).drop_duplicates().iloc[:requests]
+    quotes = [{**{f: int(row[f]) for f in predictor.numeric_features}, **{f: str(row[f]) for f in predictor.cat_features}}
+              for row in quotes.to_dict('records')]
+    results = {}
+    for module in ('serve', 'app'):
+        with TestClient(importlib.import_module(module).app) as client:
+            if module == 'serve':
+                while client.get('/ready').status_code != 200:
+                    time.sleep(0.05)
+            client.post('/predict/', json=quotes[0])
+            _, elapsed = timed(lambda: [client.post('/predict/', json=quote) for quote in quotes[1:]])
+            results[f'{module}_predict_requests_per_s'] = (len(quotes) - 1) / elapsed
+            batch = {'insureds': (quotes * (batch_size // len(quotes) + 1))[:batch_size]}
+            _, elapsed = timed(lambda: [client.post('/predict/batch', json=batch) for _ in range(5)])
+            results[f'{module}_batch_rows_per_s'] = 5 * batch_size / elapsed
+    return results
+
+def compare(results: dict, baseline_path: str):
+    with open(baseline_path, 'r') as file:
+        baseline = json.load(file)
+    print(f'\nChange against {baseline_path} (commit {baseline["meta"].get("commit")}):')
+    for name, value in results['results'].items():
+        if name in baseline['results'] and baseline['results'][name]:
+            print(f'{name:>45}: {value:12.4g} vs {baseline["results"][name]:12.4g} ({100 * (value / baseline["results"][name] - 1):+.1f}%)')
+
+#%% main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark suite on a synthetic portfolio')
+    parser.add_argument('--rows', type=int, default=200_000, help='policies in the synthetic portfolio')
+    parser.add_argument('--train-rows', type=int, default=20_000, help='training rows for the timing of each model')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quotes', type=int, default=1_000, help='single quotes timed per model and backend')
+    parser.add_argument('--batch-size', type=int, default=1_000)
+    parser.add_argument('--batches', type=int, default=50, help='batches timed per model and backend')
+    parser.add_argument('--requests', type=int, default=500, help='API requests to /predict/')
+    parser.add_argument('--output', default='benchmark-results.json', help='json file with the results')
+    parser.add_argument('--baseline', default=None, help='results of another commit to compare with')
+    parser.add_argument('--workdir', default=None, help='workspace to keep (default: a temporary folder, removed at the end)')
+    args = parser.parse_args()
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.baseline) if args.baseline else None
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='benchmark-')
+    os.makedirs(os.path.join(workdir, 'data'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'models'), exist_ok=True)
+    shutil.copy(os.path.join(repository, 'config.yml'), workdir)
+    os.chdir(workdir)
+    with open('config.yml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    results = {}
+    try:
+        results.update(bench_data(args.rows, args.seed))
+        ingestion, splits = bench_ingestion()
+        results.update(ingestion)
+        results.update(bench_training(splits, args.train_rows, config))
+        results.update(bench_prediction(splits[2], config, args.quotes, args.batch_size, args.batches))
+        results.update(bench_api(splits[2], args.requests, args.batch_size))
+    finally:
+        if args.workdir is None:
+            os.chdir(repository)
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    commit = subprocess.run(['git', '-C', repository, 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    report = {'meta': {'timestamp': datetime.now(timezone.utc).isoformat(), 'commit': commit, 'python': platform.python_version(),
+                       'machine': platform.machine(), 'cpu_count': os.cpu_count(), 'rows': args.rows, 'train_rows': args.train_rows,
+                       'seed': args.seed}, 'results': results}
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    for name, value in results.items():
+        print(f'{name:>45}: {value:12.4g}')
+    print(f'Results saved to {output}')
+    if baseline:
+        compare(report, baseline)
@@ -0,0 +1,77 @@
+#%% libraries
+import argparse
+import json
+import os
+import secrets
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+import yaml
+
+#%% per-worker memory with and without preloading the models
+# starts gunicorn with uvicorn workers twice (--preload on and off), collects the memory of
+# every worker from GET /admin/memory, then reloads the models with one POST /admin/reload,
+# waits for every worker to report the new generation and reports the memory before and
+# after; run from the repository root:
+# python -m benchmarks.worker_memory --workers 4
+# admin token of the servers started here
+token = secrets.token_hex(16)
+
+def call(url: str, method: str = 'GET') -> dict:
+    request = urllib.request.Request(url, method=method, headers={'X-Admin-Token': token})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+def per_worker(url: str, workers: int, generation: str | None = None, max_calls: int = 500) -> dict:
+    # requests are spread over the workers by the kernel: call until each pid has answered
+    # (with generation, once it has reloaded it)
+    results = {}
+    for _ in range(max_calls):
+        result = call(url)
+        if generation is None or result['generation'] == generation:
+            results.setdefault(result['pid'], result)
+        if len(results) == workers:
+            break
+        if generation is not None:
+            time.sleep(0.1)
+    return results
+
+def run(workers: int, preload: bool, port: int) -> list[dict]:
+    command = [sys.executable, '-m', 'gunicorn', 'app:app', '-k', 'uvicorn.workers.UvicornWorker',
+               '-w', str(workers), '-b', f'127.0.0.1:{port}'] + (['--preload'] if preload else [])
+    with open('config.yml', 'r') as file:
+        token_env = yaml.safe_load(file)['admin']['token_env']
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env={**os.environ, token_env: token})
+    base = f'http://127.0.0.1:{port}'
+    try:
+        for _ in range(600):
+            try:
+                call(f'{base}/')
+                break
+            except OSError:
+                time.sleep(0.1)
+        before = per_worker(f'{base}/admin/memory', workers)
+        generation = call(f'{base}/admin/reload', method='POST')['generation']
+        after = per_worker(f'{base}/admin/memory', workers, generation=generation, max_calls=1000)
+    finally:
+        server.send_signal(signal.SIGTERM)
+        server.wait()
+    return [{'preload': preload, 'pid': pid, 'rss_mb': before[pid]['rss_bytes'] / 2**20, 'pss_mb': before[pid]['pss_bytes'] / 2**20,
+             'shared_mb': before[pid]['shared_bytes'] / 2**20,
+             'pss_after_reload_mb': after[pid]['pss_bytes'] / 2**20 if pid in after else float('nan')}
+            for pid in sorted(before)]
+
+#%% main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Per-worker memory of the API with and without preloaded models')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+    print(f'{"preload":>8} {"pid":>8} {"rss MB":>8} {"pss MB":>8} {"shared MB":>10} {"pss after reload MB":>20}')
+    for preload in (False, True):
+        rows = run(args.workers, preload, args.port)
+        for row in rows:
+            print(f'{str(row["preload"]):>8} {row["pid"]:>8} {row["rss_mb"]:8.1f} {row["pss_mb"]:8.1f} {row["shared_mb"]:10.1f} {row["pss_after_reload_mb"]:20.1f}')
+        print(f'{"total":>17} {sum(r["rss_mb"] for r in rows):8.1f} {sum(r["pss_mb"] for r in rows):8.1f}')
@@ -2,43 +2,81 @@
 import pandas as pd
 import numpy as np
 import os
-from sklearn.model_selection import train_test_split
+import shutil
+import argparse
+# compact data types, shared with steps/ingest.py
+from steps.dtypes import dtypes_list, categorical_factors
 #%% Loading the dataset
 data_folder = 'data/'
 data_file = os.path.join(data_folder, 'french_mtpl.zip')
-def main():
-    dtypes_list = {'ClaimNb':np.int32, 
-    'Exposure':np.float32, 'claims_cost ':np.float32, 'Density':np.int16, 
-    'AvgClaimAmount':np.float32, 'BonusMalus':np.int16, 
-    'VehPower':np.int16, 'VehAge':np.int16, 'DrivAge':np.int16}
 
+numeric_factors = ['VehPower', 'VehAge', 'DrivAge', 'Density', 'BonusMalus']
+other_variabiles = ['Exposure', 'ClaimNb', 'IDpol', 'claims_cost']
+
+#%% reproducible 70/10/20 split on the policy id
+partitions_folder = os.path.join(data_folder, 'partitions')
+split_names = ['train', 'valid', 'test']
 
+def assign_split(idpol: pd.Series) -> np.ndarray:
+    # stable hash of IDpol mapped to [0, 1): a policy always lands in the same split,
+    # whatever the row order or chunking
+    u = pd.util.hash_pandas_object(idpol.astype(np.int64), index=False).to_numpy() / 2.0**64
+    return np.select([u < 0.7, u < 0.8], ['train', 'valid'], 'test')
+
+def main():
     df = pd.read_csv(data_file, compression='zip',  sep=";", dtype=dtypes_list)#.assign(
         # severity=lambda x: x.apply(lambda row: row['claims_cost'] / row['ClaimNb'] if row['ClaimNb'] > 0 else 0, axis=1)
         #,log_exposure = lambda x: np.log(x['Exposure'])
     #)
 
-    #%% defining predictors and target
-    numeric_factors = ['VehPower', 'VehAge', 'DrivAge', 'Density', 'BonusMalus']
-    categorical_factors = ['VehBrand', 'VehGas', 'Region','Area']
-    other_variabiles = ['Exposure', 'ClaimNb', 'IDpol', 'claims_cost']
-
-
     #%% casting the data types
     for col in categorical_factors:
         df[col] = df[col].astype('category')
 
     #%% saving the dataset
-    train_df = df.query("index <=0.7").filter(items=numeric_factors + categorical_factors + other_variabiles)
-    valid_df = df.query("0.7 < index <= 0.8").filter(items=numeric_factors + categorical_factors + other_variabiles)
-    test_df  = df.query("0.8 < index").filter(items=numeric_factors + categorical_factors + other_variabiles)
+    split = assign_split(df['IDpol'])
+    train_df = df.loc[split == 'train'].filter(items=numeric_factors + categorical_factors + other_variabiles)
+    valid_df = df.loc[split == 'valid'].filter(items=numeric_factors + categorical_factors + other_variabiles)
+    test_df  = df.loc[split == 'test'].filter(items=numeric_factors + categorical_factors + other_variabiles)
 
     #%% saving the dataset
     train_df.to_csv(os.path.join(data_folder, 'train.csv'), index=False, sep=";")
     valid_df.to_csv(os.path.join(data_folder, 'valid.csv'), index=False, sep=";")
     test_df.to_csv(os.path.join(data_folder, 'test.csv'), index=False, sep=";")
-    print('Dataset saved')
+    # partitions from a previous streaming run would shadow the csv files (see steps/ingest.py)
+    shutil.rmtree(partitions_folder, ignore_errors=True)
+    print(f'Dataset saved: train={len(train_df)}, valid={len(valid_df)}, test={len(test_df)}')
     return None
+
+#%% streaming preparation for large portfolios
+def main_streaming(chunksize: int = 500_000):
+    # reads the archive chunk by chunk and writes one typed parquet part per split and chunk
+    # under data/partitions/<split>/, so peak memory depends on chunksize only
+    shutil.rmtree(partitions_folder, ignore_errors=True)
+    for name in split_names:
+        os.makedirs(os.path.join(partitions_folder, name))
+    counts = dict.fromkeys(split_names, 0)
+    reader = pd.read_csv(data_file, compression='zip', sep=";", dtype=dtypes_list, chunksize=chunksize)
+    for i, chunk in enumerate(reader):
+        for col in categorical_factors:
+            chunk[col] = chunk[col].astype('category')
+        split = assign_split(chunk['IDpol'])
+        for name in split_names:
+            part = chunk.loc[split == name].filter(items=numeric_factors + categorical_factors + other_variabiles)
+            if len(part) > 0:
+                part.to_parquet(os.path.join(partitions_folder, name, f'part-{i:05d}.parquet'), index=False)
+                counts[name] += len(part)
+        print(f'Chunk {i} processed: ' + ', '.join(f'{name}={count}' for name, count in counts.items()))
+    print('Dataset saved: ' + ', '.join(f'{name}={count}' for name, count in counts.items()))
+    return counts
+
 # %%
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Prepare the train/valid/test splits')
+    parser.add_argument('--streaming', action='store_true', help='read the archive in chunks and write parquet partitions')
+    parser.add_argument('--chunksize', type=int, default=500_000, help='rows per chunk in streaming mode')
+    args = parser.parse_args()
+    if args.streaming:
+        main_streaming(args.chunksize)
+    else:
+        main()
\ No newline at end of file
@@ -0,0 +1,49 @@
+#%% libraries
+import argparse
+import logging
+import time
+import mlflow
+import yaml
+from steps.chunks import read_chunks
+from steps.evaluate import evaluate_chunks, save_tables
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+#%% main core
+# segmented evaluation of a validation book too large for memory: A/P by Region, Area, VehBrand and
+# BonusMalus bands, deciles and lift of both models, in one pass over the chunks of the file
+def main(input_path: str, output_dir: str, chunksize: int = 100_000, workers: int | None = None, sep: str = ';',
+         log_mlflow: bool = False) -> dict:
+    with open('config.yml', 'r') as file:
+        config = yaml.safe_load(file)
+    bands = config['evaluation']['bonus_malus_bands']
+    summaries, paths = {}, []
+    for model_type in ('frequency', 'severity'):
+        start = time.perf_counter()
+        accumulator = evaluate_chunks(read_chunks(input_path, chunksize, sep), model_type, config['models'][model_type],
+                                      workers=workers, bonus_malus_bands=bands)
+        paths += save_tables(accumulator, output_dir, f'{model_type}_')
+        summaries[model_type] = accumulator.summary()
+        logging.info(f'{model_type.capitalize()} evaluated on {summaries[model_type]["rows"]:,} rows in {time.perf_counter() - start:.1f}s: {summaries[model_type]}')
+
+    if log_mlflow:
+        mlflow.set_experiment(config['mlflow']['experiment_name'])
+        with mlflow.start_run(run_name='evaluation'):
+            mlflow.log_param('input', input_path)
+            for model_type, summary in summaries.items():
+                mlflow.log_metrics({f'{model_type}_{name}': value for name, value in summary.items()})
+            for path in paths:
+                mlflow.log_artifact(path, 'evaluation')
+    logging.info(f'Evaluation tables saved to {output_dir}')
+    return summaries
+
+#%% main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Segmented evaluation of the frequency and severity models on a validation book')
+    parser.add_argument('input', help='book as csv, parquet file or folder of parquet parts (e.g. data/partitions/test)')
+    parser.add_argument('--output-dir', default='reports', help='folder of the csv tables')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='rows per chunk')
+    parser.add_argument('--workers', type=int, default=None, help='scoring processes (default: all cores)')
+    parser.add_argument('--sep', default=';', help='csv separator')
+    parser.add_argument('--mlflow', action='store_true', help='log the tables as artifacts of a new MLflow run')
+    args = parser.parse_args()
+    main(args.input, args.output_dir, chunksize=args.chunksize, workers=args.workers, sep=args.sep, log_mlflow=args.mlflow)
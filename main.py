@@ -3,12 +3,26 @@ import logging
 import yaml
 import mlflow
 import mlflow.catboost
+from mlflow import MlflowClient
+from mlflow.entities import Metric
 from steps.ingest import Ingestion
 from steps.clean import Cleaner
 from steps.train import Trainer
 from steps.predict import Predictor
+from steps.compiled import export_model, compile_dump, CompiledModel
+from steps.evaluate import EvaluationAccumulator, evaluate_chunk, evaluate_chunks, save_tables, table_names
+from steps.stages import StageCache, digest
+from steps.cache import model_fingerprint
+import catboost
 from catboost import CatBoostRegressor
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import argparse
+import inspect
+import json
 import os
+import shutil
+import time
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
 
 #%% paths
@@ -16,8 +30,258 @@ os.makedirs('models', exist_ok=True)
 freq_model_path = os.path.join('models', 'frequency_model.cbm')
 sev_model_path = os.path.join('models', 'severity_model.cbm')
 
+#%% model settings: target, MLflow prefix and evaluation metric
+model_setup = {
+    'frequency': {'target': 'ClaimNb', 'prefix': 'freq', 'metric': 'mpd'},
+    'severity': {'target': 'severity', 'prefix': 'sev', 'metric': 'rmse'},
+}
+
+#%% stages of the single model pipeline (cached by steps/stages.py)
+def train_stage(trainer: Trainer, model_path: str, rows_path: str | None = None, full_path: str | None = None) -> dict:
+    trainer.create_pools()
+    model = trainer.train_model()
+    # compute time of the full retrain, the cost an incremental refresh is compared with
+    model.get_metadata()['compute_s'] = str(trainer.timings['create_pools_s'] + trainer.timings['fit_s'])
+    model.save_model(model_path)
+    # the last full retrain, the reference of the incremental guardrail
+    if full_path is not None:
+        shutil.copy2(model_path, full_path)
+    # rows the model has been trained on, for the next incremental refresh
+    if rows_path is not None:
+        np.save(rows_path, trainer.row_hashes(trainer.train_data))
+    return trainer.timings
+
+def incremental_stage(trainer: Trainer, new_rows: np.ndarray, model_path: str, rows_path: str, iterations: int) -> dict:
+    # trainer holds the whole training data, the new trees are fitted on the rows the model has not seen
+    delta = Trainer(target=trainer.target, train_data=trainer.train_data[new_rows], val_data=trainer.val_data, test_data=trainer.test_data,
+                    model_type=trainer.model_type, thread_count=trainer.thread_count, params=trainer.params)
+    model = delta.train_incremental(model_path, iterations)
+    model.save_model(model_path)
+    np.save(rows_path, trainer.row_hashes(trainer.train_data))
+    return delta.timings
+
+def evaluate_stage(trainer: Trainer, model_path: str) -> tuple[float, float]:
+    _, _, test_pool = trainer.create_pools()
+    return trainer.evaluate_model(CatBoostRegressor().load_model(model_path), test_pool)
+
+def export_stage(trainer: Trainer, model_type: str, model_path: str, compiled_path: str) -> float:
+    # export the NumPy evaluator of the model (see steps/compiled.py)
+    model = CatBoostRegressor().load_model(model_path)
+    export_model(model, trainer.train_data.filter(items=trainer.numeric_features + trainer.cat_features), trainer.cat_features, compiled_path)
+    # predict the test data with the reloaded model, and check the compiled one against it
+    predictions = Predictor(model, model_type=model_type).predict(trainer.test_data)
+    compiled_predictions = Predictor(CompiledModel(compiled_path), model_type=model_type).predict(trainer.test_data)
+    return float(np.max(np.abs(compiled_predictions - predictions)))
+
+def report_stage(trainer: Trainer, model_type: str, model_path: str, evaluation: dict) -> dict:
+    # segmented A/P, deciles and lift of the test split, scored in chunks across processes (steps/evaluate.py)
+    chunksize = evaluation['chunksize']
+    chunks = (trainer.test_data.iloc[i:i + chunksize] for i in range(0, len(trainer.test_data), chunksize))
+    accumulator = evaluate_chunks(chunks, model_type, model_path, workers=evaluation['workers'], bonus_malus_bands=evaluation['bonus_malus_bands'])
+    save_tables(accumulator, evaluation['report_dir'], f'{model_type}_')
+    return accumulator.summary()
+
+def report_paths(config: dict, model_type: str) -> list:
+    return [os.path.join(config['evaluation']['report_dir'], f'{model_type}_{name}.csv') for name in table_names]
+
+#%% ingest and clean the datasets of a model
+# the train stage is keyed on the whole source of these modules (Trainer.__init__, the pool cache, ...)
+train_modules = tuple(inspect.getmodule(step) for step in (Ingestion, Cleaner, Trainer))
+
+def load_data(model_type: str) -> tuple:
+    # load the datasets
+    ingestor = Ingestion()
+    if model_type == 'frequency':
+        train, valid, test = ingestor.load_freq()
+    else:
+        train, valid, test = ingestor.load_severity()
+    logging.info(f'{model_type.capitalize()} datasets loaded: train={train.shape}, valid={valid.shape}, test={test.shape}')
+    # clean the datasets
+    cleaner = Cleaner()
+    train = cleaner.clean(train, model_type)
+    valid = cleaner.clean(valid, model_type)
+    test = cleaner.clean(test, model_type)
+    logging.info(f'{model_type.capitalize()} datasets cleaned: train={train.shape}, valid={valid.shape}, test={test.shape}')
+    return train, valid, test
+
+#%% single model pipeline: ingest, clean, train, evaluate and save
+def fit_model(model_type: str, config: dict, thread_count: int = -1, force: bool = False) -> dict:
+    setup = model_setup[model_type]
+    start = time.perf_counter()
+    stages = StageCache(config['training']['stage_cache_dir'], force=force, label=f'{model_type.capitalize()} ')
+    train, valid, test = load_data(model_type)
+    # the cleaned data keys the cached stages below, so it is always recomputed
+    data_key = digest(model_type, train, valid, test)
+    stages.record('data', time.perf_counter() - start)
+
+    # train the model, with the parameters of the last hyperparameter search (python main.py --tune) if any
+    params_path = config['models'][f'{model_type}_params']
+    params = {}
+    if os.path.exists(params_path):
+        with open(params_path, 'r') as file:
+            params = json.load(file)
+    trainer = Trainer(target=setup['target'], train_data=train, val_data=valid, test_data=test, model_type=model_type,
+                      pool_cache_dir=config['training']['pool_cache_dir'], thread_count=thread_count, params=params)
+    model_path = config['models'][model_type]
+    compiled_path = config['models'][f'{model_type}_compiled']
+    rows_path = config['models'][f'{model_type}_rows']
+    train_key = digest(data_key, setup['target'], catboost.__version__, *train_modules, train_stage, params)
+    evaluate_code = (Trainer.evaluate_model, Trainer._ap_ratio)
+    incremental = config['training']['incremental']
+    results = {}
+    if incremental['enabled'] and os.path.exists(model_path):
+        # warm start: the current model keeps boosting on the training rows it has not seen (new or changed)
+        trained_rows = np.load(rows_path) if os.path.exists(rows_path) else np.empty(0, dtype=np.uint64)
+        new_rows = ~np.isin(trainer.row_hashes(train), trained_rows)
+        results['incremental_rows'] = int(new_rows.sum())
+        logging.info(f'{model_type.capitalize()} incremental training on {new_rows.sum()} new or changed rows out of {len(train)}')
+        if new_rows.any():
+            incremental_key = digest(train_key, model_fingerprint(model_path), incremental['iterations'], Trainer.train_incremental, incremental_stage)
+            timings = stages.run('train', incremental_key, lambda: incremental_stage(trainer, new_rows, model_path, rows_path, incremental['iterations']),
+                                 files=(model_path, rows_path))
+        else:
+            timings = {}
+            stages.record('train', 0.0, hit=True)
+        # the stages below depend on the resulting model
+        model_key = digest(train_key, model_fingerprint(model_path))
+        # compute time of the warm start (zero for a run without new rows)
+        results['incremental_compute_s'] = timings.get('create_pools_s', 0.0) + timings.get('fit_s', 0.0)
+        logging.info(f'{model_type.capitalize()} incremental compute time: {results["incremental_compute_s"]:.1f}s')
+    else:
+        model_key = train_key
+        full_path = config['models'][f'{model_type}_full']
+        timings = stages.run('train', train_key, lambda: train_stage(trainer, model_path, rows_path, full_path), files=(model_path, rows_path, full_path))
+    apratio, metric = stages.run('evaluate', digest(model_key, *evaluate_code), lambda: evaluate_stage(trainer, model_path))
+    logging.info(f'{model_type.capitalize()} model trained: A/P ratio={apratio:.2f}, {setup["metric"].upper()}={metric:.2f}')
+
+    if model_key != train_key and incremental['guardrail']['enabled']:
+        # guardrail: the warm started model is kept if its A/P ratio and metric on the test split are within
+        # tolerance of the last full retrain's (models/*_full.cbm, evaluated on the same split), otherwise a
+        # full retrain on the current data replaces it and becomes the new reference; only a failed check
+        # (or a missing reference) costs a full retrain
+        full_path = config['models'][f'{model_type}_full']
+        full_key = digest(train_key, *evaluate_code)
+        retrained = not os.path.exists(full_path)
+        if retrained:
+            stages.run('full_train', train_key, lambda: train_stage(trainer, full_path), files=(full_path,))
+        full_apratio, full_metric = stages.run('full_evaluate', digest(full_key, model_fingerprint(full_path)), lambda: evaluate_stage(trainer, full_path))
+        guardrail = incremental['guardrail']
+        passed = (abs(apratio - 1) <= abs(full_apratio - 1) + guardrail['apratio_tolerance']
+                  and metric <= full_metric * (1 + guardrail['metric_tolerance']))
+        logging.info(f'{model_type.capitalize()} incremental guardrail {"passed" if passed else "failed"}: A/P ratio={apratio:.3f} '
+                     f'vs {full_apratio:.3f}, {setup["metric"].upper()}={metric:.4f} vs {full_metric:.4f} on the last full retrain')
+        if not passed:
+            stages.run('full_train', train_key, lambda: train_stage(trainer, full_path), files=(full_path,))
+            retrained = True
+            shutil.copy2(full_path, model_path)
+            np.save(rows_path, trainer.row_hashes(train))
+            apratio, metric = stages.run('full_evaluate', digest(full_key, model_fingerprint(full_path)), lambda: evaluate_stage(trainer, full_path))
+            model_key = digest(train_key, model_fingerprint(model_path))
+        # net compute time saved: the full retrain avoided when the warm start is kept, the wasted warm start
+        # when a full retrain ran anyway
+        metadata = CatBoostRegressor().load_model(full_path).get_metadata()
+        full_s = float(metadata['compute_s']) if 'compute_s' in metadata else float('nan')
+        saved_s = -results['incremental_compute_s'] if retrained else full_s - results['incremental_compute_s']
+        results.update({'incremental_guardrail_passed': int(passed), 'incremental_full_retrain': int(retrained), 'full_apratio': full_apratio,
+                        f'full_{setup["metric"]}': full_metric, 'full_compute_s': full_s, 'incremental_time_saved_s': saved_s})
+        logging.info(f'{model_type.capitalize()} incremental compute time saved: {saved_s:.1f}s (full retrain {"run" if retrained else "avoided"})')
+
+    # evaluation tables, logged to MLflow by main
+    evaluation = config['evaluation']
+    os.makedirs(evaluation['report_dir'], exist_ok=True)
+    if thread_count > 0:
+        # the scoring processes stay within the CPU share of the model (see split_thread_count)
+        evaluation = {**evaluation, 'workers': min(evaluation['workers'] or os.cpu_count(), thread_count)}
+    report = stages.run('report', digest(model_key, evaluation['bonus_malus_bands'], report_stage, EvaluationAccumulator, evaluate_chunk),
+                        lambda: report_stage(trainer, model_type, model_path, evaluation), files=report_paths(config, model_type))
+    results['gini'] = report['gini']
+    logging.info(f'{model_type.capitalize()} evaluation tables saved to {evaluation["report_dir"]}: Gini={report["gini"]:.3f}')
+
+    compiled_max_abs_diff = stages.run('export', digest(model_key, export_model, compile_dump, export_stage),
+                                       lambda: export_stage(trainer, model_type, model_path, compiled_path), files=(compiled_path,))
+    logging.info(f'{model_type.capitalize()} compiled model exported: max abs difference on test={compiled_max_abs_diff:.2e}')
+
+    # training timings only when the model was trained in this run
+    return {'apratio': apratio, setup['metric']: metric, **({} if stages.summary['train_cache_hit'] else timings), **results,
+            'compiled_max_abs_diff': compiled_max_abs_diff, **{f'stage_{name}': value for name, value in stages.summary.items()},
+            'pipeline_s': time.perf_counter() - start}
+
+#%% MLflow model logging and registration
+def log_models(run, config: dict) -> str:
+    frequency_model = CatBoostRegressor().load_model(config['models']['frequency'])
+    severity_model = CatBoostRegressor().load_model(config['models']['severity'])
+    ## logging
+    mlflow.catboost.log_model(frequency_model, 'frequency_model')
+    mlflow.catboost.log_model(severity_model, 'severity_model')
+    mlflow.log_artifact(config['models']['frequency_compiled'], 'compiled_models')
+    mlflow.log_artifact(config['models']['severity_compiled'], 'compiled_models')
+    ## registering
+    ### frequency
+    frequency_model_name = 'catboost frequency model'
+    model_uri = f'runs:/{run.info.run_id}/frequency_model'
+    mlflow.register_model(model_uri, frequency_model_name)
+    ### severity
+    severity_model_name = 'catboost severity model'
+    model_uri = f'runs:/{run.info.run_id}/severity_model'
+    mlflow.register_model(model_uri, severity_model_name)
+    return run.info.run_id
+
+#%% hyperparameter search
+def tune_model(model_type: str, config: dict):
+    setup = model_setup[model_type]
+    tuning = config['tuning']
+    train, valid, test = load_data(model_type)
+    trainer = Trainer(target=setup['target'], train_data=train, val_data=valid, test_data=test, model_type=model_type,
+                      pool_cache_dir=config['training']['pool_cache_dir'])
+    client = MlflowClient()
+
+    def log_trial(result: dict):
+        # one nested run per trial, with its validation loss curve
+        with mlflow.start_run(run_name=f'{model_type} trial {result["trial"]}', nested=True) as run:
+            mlflow.log_params(result['params'])
+            mlflow.set_tag('pruned', result['pruned'])
+            mlflow.log_metrics({'best_score': result['best_score'], 'best_iteration': result['best_iteration'], 'fit_s': result['fit_s']})
+            timestamp = int(time.time() * 1000)
+            client.log_batch(run.info.run_id, metrics=[Metric('validation_loss', value, timestamp, step) for step, value in enumerate(result['curve'])])
+        logging.info(f'{model_type.capitalize()} trial {result["trial"]}: {"pruned" if result["pruned"] else "completed"} after {len(result["curve"])} '
+                     f'iterations in {result["fit_s"]:.1f}s, best validation loss={result["best_score"]:.4f}, params={result["params"]}')
+
+    with mlflow.start_run(run_name=f'{model_type} tuning'):
+        start = time.perf_counter()
+        mlflow.log_params({'trials': tuning['trials'], 'workers': tuning['workers'], 'trial_thread_count': tuning['thread_count'], 'seed': tuning['seed']})
+        best = trainer.tune(tuning['trials'], tuning['search_space'], workers=tuning['workers'], thread_count=tuning['thread_count'],
+                            iterations=tuning['iterations'], pruning=tuning['pruning'], seed=tuning['seed'], on_trial=log_trial)
+        mlflow.log_params({f'best_{name}': value for name, value in best['params'].items()})
+        mlflow.log_metrics({'best_score': best['best_score'], 'tuning_wall_s': time.perf_counter() - start})
+    # read by main.py on the next training run
+    with open(config['models'][f'{model_type}_params'], 'w') as file:
+        json.dump(best['params'], file, indent=2)
+    logging.info(f'{model_type.capitalize()} tuning done: best trial {best["trial"]} with {best["params"]}')
+    return best
+
+
+def tune(config: dict):
+    # trials are logged as nested runs to a local tracking store, one parent run per model
+    mlflow.set_tracking_uri(config['tuning']['tracking_uri'])
+    mlflow.set_experiment(f"{config['mlflow']['experiment_name']} tuning")
+    # each search takes the whole machine, the models are searched one after the other
+    for model_type in model_setup:
+        tune_model(model_type, config)
+    return None
+
+
 #%% main core
-def main():
+def split_thread_count(thread_count: dict) -> dict:
+    # models trained side by side share the cores: those left at -1 split the cores not given to the others
+    cores = os.cpu_count() or 1
+    shared = [model_type for model_type, threads in thread_count.items() if threads <= 0]
+    if not shared:
+        return dict(thread_count)
+    left = max(cores - sum(threads for threads in thread_count.values() if threads > 0), len(shared))
+    return {model_type: threads if threads > 0 else left // len(shared) + (model_type == shared[0]) * (left % len(shared))
+            for model_type, threads in thread_count.items()}
+
+def main(force: bool = False):
     # load the config file
     with open('config.yml', 'r') as file:
         config = yaml.safe_load(file)
@@ -25,78 +289,43 @@ def main():
     # loading paths
     freq_model_path = config['models']['frequency']
     sev_model_path = config['models']['severity']
+    # CPU budget of each model and whether they are trained side by side
+    parallel = config['training']['parallel']
+    thread_count = config['training']['thread_count']
+    if parallel:
+        thread_count = split_thread_count(thread_count)
 
     with mlflow.start_run() as run:
-        # load the datasets
-        ingestor = Ingestion()
-        ## frequency
-        freq_train, freq_valid, freq_test = ingestor.load_freq()
-        logging.info(f'Frequency datasets loaded: train={freq_train.shape}, valid={freq_valid.shape}, test={freq_test.shape}')
-        ## severity datasets
-        severity_train, severity_valid, severity_test = ingestor.load_severity()
-        logging.info(f'Severity datasets loaded: train={severity_train.shape}, valid={severity_valid.shape}, test={severity_test.shape}')
-        # clean the datasets
-        cleaner = Cleaner()
-        ## frequency
-        freq_train = cleaner.clean(freq_train, 'frequency')
-        freq_valid = cleaner.clean(freq_valid, 'frequency')
-        freq_test = cleaner.clean(freq_test, 'frequency')
-        logging.info(f'Frequency datasets cleaned: train={freq_train.shape}, valid={freq_valid.shape}, test={freq_test.shape}')
-        ## severity
-        severity_train = cleaner.clean(severity_train, 'severity')
-        severity_valid = cleaner.clean(severity_valid, 'severity')
-        severity_test = cleaner.clean(severity_test, 'severity')
-        logging.info(f'Severity datasets cleaned: train={severity_train.shape}, valid={severity_valid.shape}, test={severity_test.shape}')
-        
+        start = time.perf_counter()
+        mlflow.log_params({'force_recompute': force, 'incremental': config['training']['incremental']['enabled'], 'parallel_training': parallel, 'freq_thread_count': thread_count['frequency'], 'sev_thread_count': thread_count['severity']})
         # train the models
-        ## frequency
-        trainer_frequency = Trainer(target='ClaimNb', train_data=freq_train, val_data=freq_valid, test_data=freq_test)
-        _, _, test_freq_pool = trainer_frequency.create_pools()
-        frequency_model = trainer_frequency.train_model()
-        freq_apratio, freq_mpd = trainer_frequency.evaluate_model(frequency_model, test_freq_pool)
-        mlflow.log_metric('freq_apratio', freq_apratio)
-        mlflow.log_metric('freq_mpd', freq_mpd)
-        logging.info(f'Frequency model trained: A/P ratio={freq_apratio:.2f}, MPD={freq_mpd:.2f}')
-        frequency_model.save_model(freq_model_path)
-        
-        ## severity
-        trainer_severity = Trainer(target='severity', train_data=severity_train, val_data=severity_valid, test_data=severity_test, model_type='severity')
-        _, _, test_sev_pool = trainer_severity.create_pools()
-        severity_model = trainer_severity.train_model()
-        sev_apratio, sev_rmse = trainer_severity.evaluate_model(severity_model, test_sev_pool)
-        mlflow.log_metric('sev_apratio', sev_apratio)
-        mlflow.log_metric('sev_rmse', sev_rmse)
-        logging.info(f'Severity model trained: A/P ratio={sev_apratio}, RMSE={sev_rmse}')
-        severity_model.save_model(sev_model_path)
+        if parallel:
+            with ProcessPoolExecutor(max_workers=len(model_setup)) as executor:
+                futures = {model_type: executor.submit(fit_model, model_type, config, thread_count[model_type], force) for model_type in model_setup}
+                results = {model_type: future.result() for model_type, future in futures.items()}
+        else:
+            results = {model_type: fit_model(model_type, config, thread_count[model_type], force) for model_type in model_setup}
+        for model_type, result in results.items():
+            mlflow.log_metrics({f'{model_setup[model_type]["prefix"]}_{name}': value for name, value in result.items()})
+            for path in report_paths(config, model_type):
+                mlflow.log_artifact(path, f'evaluation/{model_type}')
 
         # tagging models on MLflow
         ## tagging
         mlflow.set_tag('modelli', 'catboost freqsev')
-        ## logging
-        mlflow.catboost.log_model(frequency_model, 'frequency_model')
-        mlflow.catboost.log_model(severity_model, 'severity_model')
-        ## registering
-        ### frequency
-        frequency_model_name = 'catboost frequency model'
-        model_uri = f'runs:/{run.info.run_id}/frequency_model'
-        mlflow.register_model(model_uri, frequency_model_name)
-        ### severity
-        severity_model_name = 'catboost severity model'
-        model_uri = f'runs:/{run.info.run_id}/severity_model'
-        mlflow.register_model(model_uri, severity_model_name)
-
-        # predict the test data
-        ## frequency
-        reload_freq_model = CatBoostRegressor().load_model(freq_model_path)
-        freq_predictor = Predictor(reload_freq_model, model_type='frequency')
-        freq_predictions = freq_predictor.predict(freq_test)
-        freq_predictions_total = freq_predictions.sum()
-
-        ## severity
-        
-        reload_sev_model = CatBoostRegressor().load_model(sev_model_path)
-        sev_predictor = Predictor(reload_sev_model, model_type='severity')
-        sev_predictions = sev_predictor.predict(severity_test)
+        ## logging and registering, once per model version and tracking server: the run of an
+        ## unchanged model points to the run that logged it
+        stages = StageCache(config['training']['stage_cache_dir'], force=force)
+        register_key = digest(model_fingerprint(freq_model_path, sev_model_path, config['models']['frequency_compiled'], config['models']['severity_compiled']),
+                              mlflow.get_tracking_uri(), config['mlflow']['experiment_name'], log_models)
+        models_run_id = stages.run('register', register_key, lambda: log_models(run, config))
+        mlflow.set_tag('models_run_id', models_run_id)
+        mlflow.log_metrics({f'stage_{name}': value for name, value in stages.summary.items()})
+
+        # end-to-end wall-clock time
+        wall_time = time.perf_counter() - start
+        mlflow.log_metric('pipeline_wall_s', wall_time)
+        logging.info(f'Pipeline completed in {wall_time:.1f}s (parallel={parallel})')
 
 
     return None
@@ -105,4 +334,12 @@ def main():
 
 #%% main
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description='Fit the frequency and severity models')
+    parser.add_argument('--force', action='store_true', help='recompute every stage, ignoring the stage cache')
+    parser.add_argument('--tune', action='store_true', help='search the hyperparameters of both models instead of training them')
+    args = parser.parse_args()
+    if args.tune:
+        with open('config.yml', 'r') as file:
+            tune(yaml.safe_load(file))
+    else:
+        main(force=args.force)
@@ -1,9 +1,13 @@
 #%% load key apps
 import streamlit as st
-import pandas as pd
 from catboost import CatBoostRegressor
 from typing import Literal
 from steps.predict import Predictor
+from steps.cache import QuoteCache, model_fingerprint
+from steps.premium import compute_commercial_premium
+import numpy as np
+import os
+import pandas as pd
 import yaml
 
 #%% load the config file
@@ -12,9 +16,23 @@ with open('config.yml', 'r') as file:
 
 #%% funzioni per caricare il predittore CatBoost
 @st.cache_resource
-def load_scorer(model_path, model_type):
+def load_quote_cache():
+    return QuoteCache(config['quote_cache']['max_entries']) if config['quote_cache']['enabled'] else None
+
+# content hash of a model file, hashed again only when its size or modification time changes
+@st.cache_resource(max_entries=8)
+def file_fingerprint(path, size, mtime):
+    return model_fingerprint(path)
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return file_fingerprint(path, stat.st_size, stat.st_mtime_ns)
+
+# model_version (the model file fingerprint) is part of the resource key, so a new model file is reloaded
+@st.cache_resource
+def load_scorer(model_path, model_type, model_version):
     loaded_model = CatBoostRegressor().load_model(model_path)
-    scorer = Predictor(loaded_model, model_type)
+    scorer = Predictor(loaded_model, model_type, cache=load_quote_cache(), model_version=model_version)
     return scorer
 
 #%% define the input schema
@@ -52,24 +70,58 @@ def create_expense_form():
     }
     return expenses
 
-def compute_commercial_premium(pure_premium, expenses)-> float:
-    numerator = pure_premium + expenses.get('FixedExpenses', 0)
-    denominator  = 1 - expenses.get('VariableExpenses', 0) - expenses.get('TaxRate', 0)
-    commercial_premium = numerator / denominator
-
-    return commercial_premium
-
 #%% calcola il premio puro
 def calculate_premium(policyholder, model_freq, model_sev):
-    df_insured = pd.DataFrame([policyholder])
-    # adds the log exposure = 0 and fake ClaimNb = 1
-    df_insured['log_exposure'] = 0.0
-    df_insured['ClaimNb'] = 1
-    pred_freq = model_freq.predict(df_insured)
-    pred_sev = model_sev.predict(df_insured)
+    # scores the policyholder dict directly, with unit exposure
+    pred_freq = model_freq.predict_cached(policyholder)
+    pred_sev = model_sev.predict_cached(policyholder)
     pred_pp = pred_freq[0] * pred_sev[0]
     return pred_freq[0], pred_sev[0], pred_pp
 
+#%% what-if sensitivity grid
+# values taken by each variable while the others stay as in the entered profile
+sensitivity_values = {
+    'DrivAge': np.arange(18, 101),
+    'BonusMalus': np.arange(50, 231),
+    'VehAge': np.arange(0, 31),
+    'Density': np.unique(np.geomspace(1, 30000, 60).round().astype(int)),
+}
+
+def build_sensitivity_grid(policyholder: dict) -> pd.DataFrame:
+    # the profile repeated once per varied value, one variable at a time
+    variables = np.concatenate([[name] * len(values) for name, values in sensitivity_values.items()])
+    values = np.concatenate(list(sensitivity_values.values()))
+    grid = pd.DataFrame([policyholder]).loc[np.zeros(len(values), dtype=int)].reset_index(drop=True)
+    for name in sensitivity_values:
+        grid.loc[variables == name, name] = values[variables == name]
+    return grid.assign(variable=variables, value=values)
+
+# the whole grid of all variables is scored with one call per model and cached on the profile and
+# the model version, so changing the variable, range or expenses re-renders without scoring;
+# the underscored predictors are not part of the cache key
+@st.cache_data(max_entries=256)
+def score_sensitivity(policyholder: dict, model_version: str, _model_freq: Predictor, _model_sev: Predictor) -> pd.DataFrame:
+    grid = build_sensitivity_grid(policyholder)
+    records = grid[_model_freq.numeric_features + _model_freq.cat_features].to_records(index=False)
+    frequency = _model_freq.predict_fast(records)
+    severity = _model_sev.predict_fast(records)
+    return pd.DataFrame({'variable': grid['variable'], 'value': grid['value'], 'Frequency': frequency,
+                         'Severity': severity, 'Pure_Premium': frequency * severity})
+
+def sensitivity_panel(policyholder, expenses, model_freq, model_sev, model_version):
+    st.subheader('What-if sensitivity')
+    variable = st.selectbox('Variable', list(sensitivity_values))
+    values = sensitivity_values[variable]
+    low, high = st.slider(f'{variable} range', min_value=int(values.min()), max_value=int(values.max()),
+                          value=(int(values.min()), int(values.max())))
+    grid = score_sensitivity(policyholder, model_version, model_freq, model_sev)
+    curve = grid[(grid['variable'] == variable) & grid['value'].between(low, high)].set_index('value').rename_axis(variable)
+    curve = curve.assign(Commercial_Premium=compute_commercial_premium(curve['Pure_Premium'], expenses))
+    st.write(f'Premium as {variable} varies, the other data as entered ({variable} = {policyholder[variable]}):')
+    st.line_chart(curve[['Pure_Premium', 'Commercial_Premium']])
+    st.dataframe(curve[['Frequency', 'Severity', 'Pure_Premium', 'Commercial_Premium']])
+    return None
+
 #%% inizializza il session state
 if 'button_clicked' not in st.session_state:
     st.session_state.button_clicked = False
@@ -83,8 +135,12 @@ def main():
     st.title('Insurance Premium Calculator')
 
     # load the models
-    model_freq = load_scorer(config['models']['frequency'], 'frequency')
-    model_sev = load_scorer(config['models']['severity'], 'severity')
+    freq_version = fingerprint(config['models']['frequency'])
+    sev_version = fingerprint(config['models']['severity'])
+    model_freq = load_scorer(config['models']['frequency'], 'frequency', freq_version)
+    model_sev = load_scorer(config['models']['severity'], 'severity', sev_version)
+    # version of the pair of models, part of the sensitivity cache key
+    model_version = f'{freq_version}-{sev_version}'
 
     # load the input form for policyholder data
     st.write('Insert the policyholder data:')
@@ -110,6 +166,9 @@ def main():
         st.write(f'Commercial Premium: €{commercial_premium:,.2f}')
         st.session_state.button_clicked = False
 
+    # premium across DrivAge, BonusMalus, VehAge or Density for the entered profile
+    sensitivity_panel(policyholder, expenses, model_freq, model_sev, model_version)
+
     return None
 
 if __name__ == '__main__':
@@ -0,0 +1,113 @@
+#%% libraries
+import argparse
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import yaml
+from catboost import CatBoostRegressor
+from steps.chunks import read_chunks
+from steps.predict import Predictor
+from steps.premium import compute_commercial_premium
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(message)s')
+
+#%% worker state: each process loads the two models once
+predictors = {}
+
+def init_worker(freq_model_path: str, sev_model_path: str, thread_count: int):
+    predictors['frequency'] = Predictor(CatBoostRegressor().load_model(freq_model_path), 'frequency', thread_count=thread_count)
+    predictors['severity'] = Predictor(CatBoostRegressor().load_model(sev_model_path), 'severity', thread_count=thread_count)
+    return None
+
+def score_chunk(chunk: pd.DataFrame, expenses: dict, use_exposure: bool) -> pd.DataFrame:
+    # premiums are per policy-year unless the portfolio exposure is used
+    data = chunk.assign(ClaimNb=1, log_exposure=np.log(chunk['Exposure']) if use_exposure else 0.0)
+    chunk = chunk.assign(Frequency=predictors['frequency'].predict(data), Severity=predictors['severity'].predict(data))
+    chunk['Pure_Premium'] = chunk['Frequency'] * chunk['Severity']
+    chunk['Commercial_Premium'] = compute_commercial_premium(chunk['Pure_Premium'], expenses)
+    # plain string columns, so that every chunk has the same output schema
+    for col in chunk.select_dtypes('category').columns:
+        chunk[col] = chunk[col].astype(str)
+    return chunk
+
+#%% writing in chunks (read with steps/chunks.py)
+class ChunkWriter:
+    def __init__(self, path: str, sep: str):
+        self.path = path
+        self.sep = sep
+        self._parquet = None
+        self._header = True
+
+    def write(self, chunk: pd.DataFrame):
+        if self.path.endswith('.parquet'):
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table.cast(self._parquet.schema))
+        else:
+            chunk.to_csv(self.path, sep=self.sep, index=False, mode='w' if self._header else 'a', header=self._header)
+            self._header = False
+        return None
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        return None
+
+#%% main core
+def main(input_path: str, output_path: str, expenses: dict, chunksize: int = 100_000, workers: int | None = None,
+         sep: str = ';', use_exposure: bool = False) -> int:
+    with open('config.yml', 'r') as file:
+        config = yaml.safe_load(file)
+    workers = workers or os.cpu_count()
+    # one CatBoost thread per worker, the parallelism comes from the process pool
+    init_args = (config['models']['frequency'], config['models']['severity'], 1)
+
+    writer = ChunkWriter(output_path, sep)
+    # at most two chunks per worker in flight, results are written in input order
+    pending = deque()
+    rows = 0
+    start = time.perf_counter()
+
+    def write_next():
+        nonlocal rows
+        chunk = pending.popleft().result()
+        writer.write(chunk)
+        rows += len(chunk)
+        elapsed = time.perf_counter() - start
+        logging.info(f'{rows:,} policies re-rated in {elapsed:.1f}s ({rows / elapsed:,.0f} rows/s)')
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=init_args) as executor:
+            for chunk in read_chunks(input_path, chunksize, sep):
+                pending.append(executor.submit(score_chunk, chunk, expenses, use_exposure))
+                if len(pending) >= 2 * workers:
+                    write_next()
+            while pending:
+                write_next()
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    logging.info(f'Portfolio re-rated: {rows:,} policies in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f} rows/s), saved to {output_path}')
+    return rows
+
+#%% main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Re-rate a portfolio with the frequency and severity models')
+    parser.add_argument('input', help='portfolio as csv, parquet file or folder of parquet parts')
+    parser.add_argument('output', help='output file (.csv or .parquet)')
+    parser.add_argument('--chunksize', type=int, default=100_000, help='rows per chunk')
+    parser.add_argument('--workers', type=int, default=None, help='scoring processes (default: all cores)')
+    parser.add_argument('--sep', default=';', help='csv separator')
+    parser.add_argument('--use-exposure', action='store_true', help='scale the frequency by the Exposure column')
+    parser.add_argument('--fixed-expenses', type=float, default=25.0)
+    parser.add_argument('--variable-expenses', type=float, default=0.2)
+    parser.add_argument('--tax-rate', type=float, default=0.05)
+    args = parser.parse_args()
+    expenses = {'FixedExpenses': args.fixed_expenses, 'VariableExpenses': args.variable_expenses, 'TaxRate': args.tax_rate}
+    main(args.input, args.output, expenses, chunksize=args.chunksize, workers=args.workers, sep=args.sep, use_exposure=args.use_exposure)
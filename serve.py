@@ -0,0 +1,97 @@
+#%% required libraries
+# slim serving entry point: imports only what scoring needs (FastAPI, NumPy and the compiled
+# models of steps/compiled.py); catboost is imported only with serving.backend: 'catboost'
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel, Field
+from steps.predict import Predictor
+from steps.compiled import CompiledModel
+from steps.cache import model_fingerprint
+from steps.schemas import Insured, BatchInsured, PredictionResponse, BatchPredictionResponse
+import asyncio
+import logging
+import time
+import numpy as np
+import yaml
+
+#%% load the config file
+with open('config.yml', 'r') as file:
+    config = yaml.safe_load(file)
+max_batch_size = config['api']['max_batch_size']
+backend = config['serving']['backend']
+warmup_rounds = config['serving']['warmup_rounds']
+
+app = FastAPI()
+
+# Input schema for a batch of insured persons (schemas in steps/schemas.py)
+class BatchRequest(BaseModel):
+    insureds: list[BatchInsured] = Field(title='Insureds', description='Insured persons to quote', min_length=1, max_length=max_batch_size)
+
+# Loaded models and readiness: ready flips once the models have been validated and warmed up
+predictors = {}
+state = {'ready': False, 'model_version': None, 'startup_s': {}}
+probe = {'VehPower': 5, 'VehAge': 1, 'DrivAge': 35, 'Density': 100, 'BonusMalus': 100,
+         'VehBrand': 'B12', 'VehGas': 'Regular', 'Region': 'R11', 'Area': 'A'}
+
+def load_model(model_type: str):
+    if backend == 'compiled':
+        return CompiledModel(config['models'][f'{model_type}_compiled'])
+    from catboost import CatBoostRegressor
+    return CatBoostRegressor().load_model(config['models'][model_type])
+
+def warm_up():
+    # first calls allocate the NumPy buffers and the batch code paths
+    start = time.perf_counter()
+    batch = [dict(probe, DrivAge=18 + i % 80) for i in range(64)]
+    for _ in range(warmup_rounds):
+        for predictor in predictors.values():
+            predictor.predict_fast(probe)
+            predictor.predict_fast(batch)
+    state['startup_s']['warm_up'] = time.perf_counter() - start
+    state['ready'] = True
+    logging.info(f'Models warm in {state["startup_s"]["warm_up"]:.3f}s, ready to serve')
+
+# Load and validate the models as a startup event: a missing or broken model stops the startup,
+# the warm up runs in the background while the readiness probe answers 503
+@app.on_event("startup")
+async def load_models():
+    start = time.perf_counter()
+    for model_type in ('frequency', 'severity'):
+        predictors[model_type] = Predictor(load_model(model_type), model_type)
+    state['startup_s']['load'] = time.perf_counter() - start
+    for model_type, predictor in predictors.items():
+        prediction = predictor.predict_fast(probe)
+        if not (np.all(np.isfinite(prediction)) and np.all(prediction > 0)):
+            raise ValueError(f'{model_type} model returned {prediction} on the probe record')
+    suffix = '_compiled' if backend == 'compiled' else ''
+    state['model_version'] = model_fingerprint(config['models'][f'frequency{suffix}'], config['models'][f'severity{suffix}'])
+    state['warm_up_task'] = asyncio.create_task(asyncio.to_thread(warm_up))
+
+
+# Liveness: the process is up
+@app.get("/", response_model=dict)
+async def read_root():
+    return {"Health check": "OK"}
+
+# Readiness: models loaded, validated and warm
+@app.get("/ready", response_model=dict)
+async def ready():
+    content = {'ready': state['ready'], 'backend': backend, 'model_version': state['model_version'], 'startup_s': state['startup_s']}
+    return JSONResponse(content, status_code=200 if state['ready'] else 503)
+
+# Prediction endpoint
+@app.post("/predict/", response_model=PredictionResponse)
+async def predict(insured: Insured):
+    insured_data = insured.dict()
+    pred_freq = predictors['frequency'].predict_fast(insured_data)[0]
+    pred_sev = predictors['severity'].predict_fast(insured_data)[0]
+    return PredictionResponse(Frequency=pred_freq, Severity=pred_sev, Pure_Premium=pred_freq * pred_sev)
+
+# Batch prediction endpoint, declared sync so FastAPI runs the scoring in its threadpool
+@app.post("/predict/batch", response_model=BatchPredictionResponse)
+def predict_batch(batch: BatchRequest):
+    records = [insured.dict() for insured in batch.insureds]
+    pred_freq = predictors['frequency'].predict_fast(records)
+    pred_sev = predictors['severity'].predict_fast(records)
+    pure_premium = pred_freq * pred_sev
+    return BatchPredictionResponse(Frequency=pred_freq.tolist(), Severity=pred_sev.tolist(), Pure_Premium=pure_premium.tolist())
@@ -0,0 +1,79 @@
+#%% import libraries
+import asyncio
+from collections import Counter
+from typing import Any, Callable
+
+#%% micro batching dispatcher
+# collects concurrent requests for at most window_ms after the first one arrives (or until
+# max_batch_size are queued), scores them with one score_fn call on a worker thread
+# (list of records in, list of results in the same order out) and answers each caller
+class MicroBatcher:
+    def __init__(self, score_fn: Callable[[list], list], window_ms: float = 2.0, max_batch_size: int = 64):
+        self.score_fn = score_fn
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.batch_sizes = Counter()
+        self._queue = None
+        self._task = None
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+        return None
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        return None
+
+    async def submit(self, record: Any) -> Any:
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((record, future))
+        return await future
+
+    async def _collect(self) -> list:
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.window
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            records = [record for record, _ in batch]
+            try:
+                results = await asyncio.to_thread(self.score_fn, records)
+            except Exception as exc:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(exc)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+            self.batch_sizes[len(batch)] += 1
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        requests = sum(size * count for size, count in self.batch_sizes.items())
+        return {
+            'window_ms': self.window * 1000,
+            'max_batch_size': self.max_batch_size,
+            'batches': batches,
+            'requests': requests,
+            'mean_batch_size': requests / batches if batches else 0.0,
+            'batch_sizes': dict(sorted(self.batch_sizes.items())),
+        }
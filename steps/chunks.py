@@ -0,0 +1,16 @@
+#%% import libraries
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+from steps.dtypes import dtypes_list
+
+#%% books read in chunks (rerate.py and evaluate.py)
+def read_chunks(path: str, chunksize: int, sep: str):
+    # csv file, parquet file or folder of parquet parts (e.g. data/partitions/test)
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        files = [path] if os.path.isfile(path) else sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.parquet'))
+        for file in files:
+            for batch in pq.ParquetFile(file).iter_batches(batch_size=chunksize):
+                yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(path, sep=sep, dtype=dtypes_list, chunksize=chunksize)
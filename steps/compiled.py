@@ -0,0 +1,273 @@
+#%% import libraries
+import json
+import os
+import tempfile
+import numpy as np
+
+#%% constants of the CatBoost hashing scheme
+# projection hashes combine the categorical hashes (int32, sign extended to 64 bits)
+# and binary feature values as h = MAGIC * (h + MAGIC * value) modulo 2**64
+MAGIC_MULT = np.uint64(0x4906ba494954cb65)
+UNKNOWN_CAT_HASH = 0x7fffffff
+# split kinds and projection element kinds
+FLOAT_SPLIT, ONE_HOT_SPLIT, CTR_SPLIT = 0, 1, 2
+CAT_VALUE, FLOAT_BINARIZED, CAT_EXACT_VALUE = 0, 1, 2
+# losses whose prediction is the exponent of the formula value (as CatBoostRegressor.predict)
+EXPONENT_LOSSES = ('Poisson', 'Tweedie')
+
+#%% export: CatBoost JSON dump -> arrays
+def export_model(model, data, cat_features: list, path: str):
+    # the JSON dump needs a pool with the categorical values to store their hashes
+    from catboost import Pool
+    pool = Pool(data=data, cat_features=cat_features)
+    with tempfile.TemporaryDirectory() as folder:
+        dump_path = os.path.join(folder, 'model.json')
+        model.save_model(dump_path, format='json', pool=pool)
+        with open(dump_path, 'r') as file:
+            dump = json.load(file)
+    np.savez_compressed(path, **compile_dump(dump))
+    return None
+
+def compile_dump(dump: dict) -> dict:
+    info = dump['features_info']
+    float_features = sorted(info.get('float_features', []), key=lambda f: f['feature_index'])
+    cat_features = sorted(info.get('categorical_features', []), key=lambda f: f['feature_index'])
+    ctrs = info.get('ctrs', [])
+
+    # split table, in CatBoost's split_index order: float borders, one-hot values, ctr borders
+    split_kind, split_feature, split_border, split_value = [], [], [], []
+    for feature in float_features:
+        for border in feature.get('borders') or []:
+            split_kind.append(FLOAT_SPLIT); split_feature.append(feature['feature_index']); split_border.append(border); split_value.append(0)
+    for feature in cat_features:
+        # one-hot values are hashes, written as signed int32 by the dump (as the exact values of the
+        # projections below): wrapped to uint32 in the arrays
+        for value in feature.get('values', []):
+            split_kind.append(ONE_HOT_SPLIT); split_feature.append(feature['feature_index']); split_border.append(0.0); split_value.append(value)
+    for i, ctr in enumerate(ctrs):
+        for border in ctr['borders']:
+            split_kind.append(CTR_SPLIT); split_feature.append(i); split_border.append(border); split_value.append(0)
+
+    # categorical value -> hash, sorted for np.searchsorted
+    cat_hashes = sorted((str(item['value']), item['hash']) for item in info.get('cat_features_hash', []))
+
+    # projections (the combinations the ctrs are computed on) and their count tables
+    projections = list(dict.fromkeys(ctr['identifier'] for ctr in ctrs))
+    elem_kind, elem_feature, elem_border, elem_value, elem_offsets = [], [], [], [], [0]
+    table_keys, table_counts, table_offsets, count_offsets, table_strides, table_denominators = [], [], [0], [0], [], []
+    for identifier in projections:
+        elements = json.loads(identifier)['identifier']
+        # categorical values are hashed first, then the binary features
+        elements = [e for e in elements if e['combination_element'] == 'cat_feature_value'] + \
+                   [e for e in elements if e['combination_element'] != 'cat_feature_value']
+        for element in elements:
+            kind = element['combination_element']
+            if kind == 'cat_feature_value':
+                elem_kind.append(CAT_VALUE); elem_feature.append(element['cat_feature_index']); elem_border.append(0.0); elem_value.append(0)
+            elif kind == 'float_feature':
+                elem_kind.append(FLOAT_BINARIZED); elem_feature.append(element['float_feature_index']); elem_border.append(element['border']); elem_value.append(0)
+            elif kind == 'cat_feature_exact_value':
+                elem_kind.append(CAT_EXACT_VALUE); elem_feature.append(element['cat_feature_index']); elem_border.append(0.0); elem_value.append(element['value'])
+            else:
+                raise NotImplementedError(f'Unsupported projection element: {kind}')
+        elem_offsets.append(len(elem_kind))
+
+        table = dump['ctr_data'][identifier]
+        stride = table['hash_stride']
+        hash_map = table['hash_map']
+        keys = np.array([int(h) for h in hash_map[::stride]], dtype=np.uint64)
+        counts = np.array(hash_map, dtype=object).reshape(-1, stride)[:, 1:].astype(np.float64)
+        order = np.argsort(keys)
+        table_keys.append(keys[order])
+        table_counts.append(counts[order].ravel())
+        table_offsets.append(table_offsets[-1] + len(keys))
+        count_offsets.append(count_offsets[-1] + counts.size)
+        table_strides.append(stride - 1)
+        table_denominators.append(table.get('counter_denominator', 0))
+
+    ctr_types = [ctr['ctr_type'] for ctr in ctrs]
+    unsupported = set(ctr_types) - {'Borders', 'Buckets', 'Counter', 'FeatureFreq'}
+    if unsupported:
+        raise NotImplementedError(f'Unsupported ctr types: {sorted(unsupported)}')
+
+    # oblivious trees: split indices (bit d of the leaf index is split d) and leaf values
+    trees = dump['oblivious_trees']
+    tree_depth = [len(tree['splits'] or []) for tree in trees]
+    tree_splits = [split['split_index'] for tree in trees for split in (tree['splits'] or [])]
+    leaf_values = [value for tree in trees for value in tree['leaf_values']]
+
+    scale, bias = dump['scale_and_bias']
+    loss = dump['model_info'].get('params', {}).get('loss_function', {}).get('type', '')
+    return {
+        'n_float': np.int64(len(float_features)),
+        'n_cat': np.int64(len(cat_features)),
+        'split_kind': np.array(split_kind, dtype=np.int8),
+        'split_feature': np.array(split_feature, dtype=np.int32),
+        'split_border': np.array(split_border, dtype=np.float32),
+        'split_value': np.array(split_value, dtype=np.int64).astype(np.uint32),
+        'cat_values': np.array([value for value, _ in cat_hashes], dtype=str),
+        'cat_hashes': np.array([h for _, h in cat_hashes], dtype=np.uint32),
+        'elem_kind': np.array(elem_kind, dtype=np.int8),
+        'elem_feature': np.array(elem_feature, dtype=np.int32),
+        'elem_border': np.array(elem_border, dtype=np.float32),
+        'elem_value': np.array(elem_value, dtype=np.int64).astype(np.uint32),
+        'elem_offsets': np.array(elem_offsets, dtype=np.int64),
+        'table_keys': np.concatenate(table_keys) if table_keys else np.zeros(0, dtype=np.uint64),
+        'table_counts': np.concatenate(table_counts) if table_counts else np.zeros(0),
+        'table_offsets': np.array(table_offsets, dtype=np.int64),
+        'count_offsets': np.array(count_offsets, dtype=np.int64),
+        'table_strides': np.array(table_strides, dtype=np.int64),
+        'table_denominators': np.array(table_denominators, dtype=np.float64),
+        'ctr_projection': np.array([projections.index(ctr['identifier']) for ctr in ctrs], dtype=np.int32),
+        'ctr_type': np.array(ctr_types, dtype=str),
+        'ctr_prior_num': np.array([ctr['prior_numerator'] for ctr in ctrs], dtype=np.float32),
+        'ctr_prior_denom': np.array([ctr['prior_denomerator'] for ctr in ctrs], dtype=np.float32),
+        'ctr_shift': np.array([ctr['shift'] for ctr in ctrs], dtype=np.float32),
+        'ctr_scale': np.array([ctr['scale'] for ctr in ctrs], dtype=np.float32),
+        'ctr_target_border_idx': np.array([ctr['target_border_idx'] for ctr in ctrs], dtype=np.int64),
+        'tree_depth': np.array(tree_depth, dtype=np.int64),
+        'tree_splits': np.array(tree_splits, dtype=np.int64),
+        'leaf_values': np.array(leaf_values, dtype=np.float64),
+        'scale': np.float64(scale),
+        'bias': np.float64(bias[0] if bias else 0.0),
+        'loss': np.array(loss),
+    }
+
+#%% compiled model: vectorized evaluation with NumPy only
+class CompiledModel:
+    def __init__(self, path: str, block_size: int = 4096):
+        with np.load(path) as arrays:
+            self.arrays = {name: arrays[name] for name in arrays.files}
+        for name, value in self.arrays.items():
+            setattr(self, name, value)
+        self.loss = str(self.loss)
+        self.block_size = block_size
+        # trees padded to the maximum depth; padding points to an always-false split
+        n_splits = len(self.split_kind)
+        depth = self.tree_depth
+        max_depth = int(depth.max()) if len(depth) else 0
+        starts = np.concatenate([[0], np.cumsum(depth)[:-1]]).astype(np.int64)
+        self.tree_split_matrix = np.full((len(depth), max_depth), n_splits, dtype=np.int64)
+        for d in range(max_depth):
+            has_level = depth > d
+            self.tree_split_matrix[has_level, d] = self.tree_splits[starts[has_level] + d]
+        self.leaf_offsets = np.concatenate([[0], np.cumsum(1 << depth)[:-1]]).astype(np.int64)
+        # vectorized ctrs: projection elements by kind and by position, table search depth,
+        # cumulative counts and ctr type masks
+        self.elem_groups = {kind: np.flatnonzero(self.elem_kind == kind) for kind in (CAT_VALUE, FLOAT_BINARIZED, CAT_EXACT_VALUE)
+                            if np.any(self.elem_kind == kind)}
+        lengths = np.diff(self.elem_offsets)
+        self.elem_positions = [np.flatnonzero(lengths > position) for position in range(int(lengths.max()) if len(lengths) else 0)]
+        table_sizes = np.diff(self.table_offsets)
+        self.search_steps = int(table_sizes.max()).bit_length() if len(table_sizes) else 0
+        self.search_rows = 64
+        self.count_cumsum = np.concatenate([[0.0], np.cumsum(self.table_counts)])
+        self.ctr_is_counter = np.isin(self.ctr_type, ['Counter', 'FeatureFreq'])
+        self.ctr_is_buckets = self.ctr_type == 'Buckets'
+        self.ctr_is_borders = self.ctr_type == 'Borders'
+
+    def _hash_cat(self, cat: np.ndarray) -> np.ndarray:
+        # categorical value -> CatBoost hash (uint32); unseen values get the exporter's sentinel
+        values = np.asarray(cat).astype(str)
+        if len(self.cat_values) == 0:
+            return np.full(values.shape, UNKNOWN_CAT_HASH, dtype=np.uint32)
+        position = np.clip(np.searchsorted(self.cat_values, values), 0, len(self.cat_values) - 1)
+        return np.where(self.cat_values[position] == values, self.cat_hashes[position], UNKNOWN_CAT_HASH).astype(np.uint32)
+
+    def _search(self, h: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        # position of each projection hash in the sorted keys of its projection, and whether it is there
+        n, n_projections = h.shape
+        keys = self.table_keys if len(self.table_keys) else np.zeros(1, dtype=np.uint64)
+        last_key = len(keys) - 1
+        if n >= self.search_rows:
+            # large batches: one sorted search per projection
+            lo = np.empty((n, n_projections), dtype=np.int64)
+            for p in range(n_projections):
+                start, end = self.table_offsets[p], self.table_offsets[p + 1]
+                lo[:, p] = start + np.searchsorted(self.table_keys[start:end], h[:, p])
+        else:
+            # few rows: binary search of all projections at once, bounded by the largest table
+            lo = np.broadcast_to(self.table_offsets[:-1], (n, n_projections)).copy()
+            hi = np.broadcast_to(self.table_offsets[1:], (n, n_projections)).copy()
+            for _ in range(self.search_steps):
+                mid = (lo + hi) // 2
+                active = lo < hi
+                less = keys[np.minimum(mid, last_key)] < h
+                lo = np.where(active & less, mid + 1, lo)
+                hi = np.where(active & ~less, mid, hi)
+        matched = (lo < self.table_offsets[1:]) & (keys[np.minimum(lo, last_key)] == h)
+        return lo, matched
+
+    def _ctrs(self, num: np.ndarray, hashes: np.ndarray) -> np.ndarray:
+        # all projections and ctrs at once, so that the cost of a single quote does not grow
+        # with the number of ctrs in Python overhead
+        n, n_projections = len(num), len(self.table_strides)
+        # sign extended categorical hashes, as used in the projection hash
+        hashes64 = hashes.view(np.int32).astype(np.int64).view(np.uint64)
+        values = np.zeros((n, len(self.elem_kind)), dtype=np.uint64)
+        for kind, elements in self.elem_groups.items():
+            features = self.elem_feature[elements]
+            if kind == CAT_VALUE:
+                values[:, elements] = hashes64[:, features]
+            elif kind == FLOAT_BINARIZED:
+                values[:, elements] = num[:, features] > self.elem_border[elements]
+            else:
+                values[:, elements] = hashes[:, features] == self.elem_value[elements]
+        # projection hash of every row, folded one element position at a time
+        h = np.zeros((n, n_projections), dtype=np.uint64)
+        for position, projections in enumerate(self.elem_positions):
+            h[:, projections] = MAGIC_MULT * (h[:, projections] + MAGIC_MULT * values[:, self.elem_offsets[projections] + position])
+        lo, matched = self._search(h)
+
+        # counts of the matched bucket of each ctr, through cumulative sums as strides differ
+        projection = self.ctr_projection
+        stride = self.table_strides[projection]
+        matched = matched[:, projection]
+        start = np.where(matched, self.count_offsets[projection] + (lo[:, projection] - self.table_offsets[projection]) * stride, 0)
+        end = np.minimum(start + stride, len(self.count_cumsum) - 1)
+        total = np.where(matched, self.count_cumsum[end] - self.count_cumsum[start], 0)
+        found = total > 0
+        index = np.minimum(start + np.where(self.ctr_is_buckets, self.ctr_target_border_idx, 0), len(self.table_counts) - 1)
+        single = np.where(matched, self.table_counts[index], 0) if len(self.table_counts) else np.zeros_like(total)
+        above = np.clip(start + self.ctr_target_border_idx + 1, start, end)
+        borders = np.where(matched, self.count_cumsum[end] - self.count_cumsum[above], 0)
+        good = np.where(self.ctr_is_borders, borders, single)
+        total = np.where(self.ctr_is_counter, np.where(found, self.table_denominators[projection], 0), total)
+        ctr = (good.astype(np.float32) + self.ctr_prior_num) / (total.astype(np.float32) + self.ctr_prior_denom)
+        return ((ctr + self.ctr_shift) * self.ctr_scale).astype(np.float32)
+
+    def _binary_features(self, num: np.ndarray, hashes: np.ndarray, ctr_values: np.ndarray) -> np.ndarray:
+        # one column per split, plus a trailing always-false column for tree padding
+        bits = np.zeros((len(num), len(self.split_kind) + 1), dtype=bool)
+        for kind, source in ((FLOAT_SPLIT, num), (ONE_HOT_SPLIT, hashes), (CTR_SPLIT, ctr_values)):
+            splits = np.flatnonzero(self.split_kind == kind)
+            if len(splits) == 0:
+                continue
+            values = source[:, self.split_feature[splits]]
+            if kind == ONE_HOT_SPLIT:
+                bits[:, splits] = values == self.split_value[splits]
+            else:
+                bits[:, splits] = values > self.split_border[splits]
+        return bits
+
+    def predict_raw(self, num: np.ndarray, cat: np.ndarray) -> np.ndarray:
+        num = np.asarray(num, dtype=np.float32).reshape(-1, self.n_float)
+        cat = np.asarray(cat, dtype=object).reshape(len(num), self.n_cat)
+        hashes = self._hash_cat(cat)
+        raw = np.empty(len(num))
+        # rows in blocks, to bound the rows x ctrs and rows x trees intermediates
+        for start in range(0, len(num), self.block_size):
+            block_num, block_hashes = num[start:start + self.block_size], hashes[start:start + self.block_size]
+            block = self._binary_features(block_num, block_hashes, self._ctrs(block_num, block_hashes))
+            leaf_index = np.zeros((len(block), len(self.tree_depth)), dtype=np.int64)
+            for d in range(self.tree_split_matrix.shape[1]):
+                leaf_index |= block[:, self.tree_split_matrix[:, d]].astype(np.int64) << d
+            raw[start:start + self.block_size] = self.leaf_values[self.leaf_offsets + leaf_index].sum(axis=1)
+        return self.scale * raw + self.bias
+
+    def predict(self, num: np.ndarray, cat: np.ndarray, baseline: np.ndarray | None = None) -> np.ndarray:
+        # same prediction type as CatBoostRegressor.predict: exponent for Poisson/Tweedie, raw otherwise
+        raw = self.predict_raw(num, cat)
+        if baseline is not None:
+            raw = raw + np.asarray(baseline, dtype=np.float32)
+        return np.exp(raw) if self.loss in EXPONENT_LOSSES else raw
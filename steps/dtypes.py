@@ -0,0 +1,9 @@
+#%% Importing libraries
+import numpy as np
+
+#%% compact data types of the French MTPL columns (dataset.py, steps/ingest.py, steps/chunks.py and synthetic.py)
+dtypes_list = {'ClaimNb':np.int32, 
+'Exposure':np.float32, 'claims_cost':np.float32, 'Density':np.int16, 
+'AvgClaimAmount':np.float32, 'BonusMalus':np.int16, 
+'VehPower':np.int16, 'VehAge':np.int16, 'DrivAge':np.int16}
+categorical_factors = ['VehBrand', 'VehGas', 'Region','Area']
@@ -0,0 +1,189 @@
+#%% import libraries
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import get_args
+import numpy as np
+import pandas as pd
+from catboost import CatBoostRegressor
+from steps.clean import Cleaner
+from steps.predict import Predictor
+from steps.schemas import Insured
+
+#%% segments and accumulated statistics
+# categorical levels of the API schema (levels it does not know are summed as 'other') and lower
+# edges of the BonusMalus bands (the last band is open)
+segment_levels = {name: list(get_args(Insured.model_fields[name].annotation)) for name in ('Region', 'Area', 'VehBrand')}
+default_bonus_malus_bands = [50, 51, 60, 70, 80, 90, 100, 125, 150]
+# predicted rates binned on a log scale for the lift curve, Gini and deciles: bins 0.01% wide over
+# [1e-6, 1e6], kept sparse (only the bins rows fall in), so that predictions in a narrow range are
+# still ranked finely; the distinct bins bound the memory, whatever the number of rows
+rank_width = 1e-4
+rank_range = (1e-6, 1e6)
+# per segment or bin: rows, weight (exposure or claims), actual and predicted (claim counts or claims
+# costs, both weighted like the model) and loss (Poisson unit deviance or squared error) sums; MPD/RMSE
+# are computed as in Trainer.evaluate_model, the severity A/P ratio is weighted by the claim counts
+statistics = ['rows', 'weight', 'actual', 'predicted', 'loss']
+# tables of EvaluationAccumulator.tables
+table_names = list(segment_levels) + ['BonusMalus', 'deciles', 'lift']
+
+def prepare_chunk(chunk: pd.DataFrame, model_type: str) -> pd.DataFrame:
+    # rows of a split as read from data/*.csv, with the columns added by steps/ingest.py
+    chunk = Cleaner().clean(chunk, model_type)
+    if model_type == 'frequency':
+        return chunk.assign(log_exposure=np.log(chunk['Exposure']))
+    return chunk.assign(severity=chunk['claims_cost'].div(chunk['ClaimNb']).where(chunk['ClaimNb'] > 0, 0))
+
+class EvaluationAccumulator:
+    def __init__(self, model_type: str, bonus_malus_bands: list = default_bonus_malus_bands):
+        self.model_type = model_type
+        self.bonus_malus_bands = np.asarray(bonus_malus_bands)
+        # fixed size: one row per level (plus 'other') or band; one row per rank bin used, in rank_keys order
+        self.segments = {name: np.zeros((len(levels) + 1, len(statistics))) for name, levels in segment_levels.items()}
+        self.segments['BonusMalus'] = np.zeros((len(bonus_malus_bands), len(statistics)))
+        self.rank_keys = np.zeros(0, dtype=np.int64)
+        self.ranks = np.zeros((0, len(statistics)))
+
+    def add(self, chunk: pd.DataFrame, predicted: np.ndarray):
+        predicted = np.asarray(predicted, dtype=np.float64)
+        if self.model_type == 'frequency':
+            actual = chunk['ClaimNb'].to_numpy(dtype=np.float64)
+            weight = chunk['Exposure'].to_numpy(dtype=np.float64)
+            rate = predicted / weight
+            loss = 2 * (np.where(actual > 0, actual * np.log(np.maximum(actual, 1e-300) / predicted), 0) - actual + predicted)
+        else:
+            # claims only, as Trainer.evaluate_model; the actual and predicted severities are weighted by the
+            # claim counts, as in training, so that the Lorenz curve and deciles compare costs against claims
+            claims = chunk['ClaimNb'].to_numpy() > 0
+            chunk, rate = chunk[claims], predicted[claims]
+            severity = chunk['severity'].to_numpy(dtype=np.float64)
+            weight = chunk['ClaimNb'].to_numpy(dtype=np.float64)
+            actual, predicted = severity * weight, rate * weight
+            loss = (severity - rate) ** 2
+        values = np.column_stack([np.ones_like(actual), weight, actual, predicted, loss])
+
+        for name, levels in segment_levels.items():
+            codes = pd.Categorical(chunk[name].astype(str), categories=levels).codes
+            self.segments[name] += self._sums(np.where(codes < 0, len(levels), codes), values, len(levels) + 1)
+        bands = np.searchsorted(self.bonus_malus_bands, chunk['BonusMalus'].to_numpy(), side='right') - 1
+        self.segments['BonusMalus'] += self._sums(np.clip(bands, 0, len(self.bonus_malus_bands) - 1), values, len(self.bonus_malus_bands))
+        self._add_ranks(np.floor(np.log(np.clip(rate, *rank_range)) / rank_width).astype(np.int64), values)
+        return self
+
+    def _add_ranks(self, keys: np.ndarray, values: np.ndarray):
+        keys, index = np.unique(np.concatenate([self.rank_keys, keys]), return_inverse=True)
+        self.ranks = self._sums(index, np.vstack([self.ranks, values]), len(keys))
+        self.rank_keys = keys
+        return None
+
+    @staticmethod
+    def _sums(index: np.ndarray, values: np.ndarray, size: int) -> np.ndarray:
+        return np.column_stack([np.bincount(index, weights=values[:, j], minlength=size) for j in range(values.shape[1])])
+
+    def merge(self, other: 'EvaluationAccumulator'):
+        for name in self.segments:
+            self.segments[name] += other.segments[name]
+        self._add_ranks(other.rank_keys, other.ranks)
+        return self
+
+    def _table(self, sums: np.ndarray, index: list, name: str) -> pd.DataFrame:
+        table = pd.DataFrame(sums, columns=statistics, index=pd.Index(index, name=name))
+        table = table[table['rows'] > 0].astype({'rows': np.int64})
+        table['apratio'] = table['actual'] / table['predicted']
+        if self.model_type == 'frequency':
+            table['mpd'] = table['loss'] / table['rows']
+        else:
+            table['rmse'] = np.sqrt(table['loss'] / table['rows'])
+        return table.drop(columns='loss')
+
+    def summary(self) -> dict:
+        rows, weight, actual, predicted, loss = self.ranks.sum(axis=0)
+        metric = {'mpd': float(loss / rows)} if self.model_type == 'frequency' else {'rmse': float(np.sqrt(loss / rows))}
+        return {'rows': int(rows), 'apratio': float(actual / predicted), **metric, 'gini': self.gini()}
+
+    def _lorenz(self) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # cumulative shares of weight, actual and predicted, from the lowest predicted rate up
+        ranks = self.ranks[self.ranks[:, 0] > 0]
+        shares = [np.concatenate([[0.0], np.cumsum(ranks[:, j]) / ranks[:, j].sum()]) for j in (1, 2, 3)]
+        return tuple(shares)
+
+    def gini(self) -> float:
+        # ordered Lorenz curve of the actual against the weight: 0 for no segmentation, up to 1
+        weight, actual, _ = self._lorenz()
+        return float(1 - np.sum(np.diff(weight) * (actual[1:] + actual[:-1])))
+
+    def lift(self, points: int = 100) -> pd.DataFrame:
+        weight, actual, predicted = self._lorenz()
+        share = np.linspace(0, 1, points + 1)
+        return pd.DataFrame({'weight_share': share, 'actual_share': np.interp(share, weight, actual),
+                             'predicted_share': np.interp(share, weight, predicted)})
+
+    def deciles(self) -> pd.DataFrame:
+        # equal weight deciles of the predicted rate: the cut points are the weighted deciles, and the rank bin
+        # a cut point falls in is split between the two deciles in proportion to the weight on each side
+        weight = self.ranks[:, 1]
+        cumulative = np.concatenate([[0.0], np.cumsum(weight)])
+        cuts = cumulative[-1] * np.arange(11) / 10
+        sums, rate_from, rate_to = np.zeros((10, len(statistics))), [], []
+        for d in range(10):
+            overlap = np.clip(np.minimum(cumulative[1:], cuts[d + 1]) - np.maximum(cumulative[:-1], cuts[d]), 0, None)
+            share = np.divide(overlap, weight, out=np.zeros_like(weight), where=weight > 0)
+            sums[d] = share @ self.ranks
+            keys = self.rank_keys[share > 1e-12]
+            rate_from.append(np.exp(keys.min() * rank_width) if len(keys) else np.nan)
+            rate_to.append(np.exp((keys.max() + 1) * rank_width) if len(keys) else np.nan)
+        # split bins leave fractions of rows
+        sums[:, 0] = np.round(sums[:, 0])
+        table = self._table(sums, list(range(1, 11)), 'decile')
+        table['rate_from'] = pd.Series(rate_from, index=range(1, 11))
+        table['rate_to'] = pd.Series(rate_to, index=range(1, 11))
+        table['actual_rate'] = table['actual'] / table['weight']
+        table['predicted_rate'] = table['predicted'] / table['weight']
+        table['lift'] = table['actual_rate'] / (table['actual'].sum() / table['weight'].sum())
+        return table
+
+    def tables(self) -> dict:
+        tables = {name: self._table(sums, segment_levels[name] + ['other'], name) for name, sums in self.segments.items() if name in segment_levels}
+        band_edges = list(self.bonus_malus_bands)
+        band_labels = [f'{low}-{high - 1}' if high - 1 > low else f'{low}' for low, high in zip(band_edges[:-1], band_edges[1:])] + [f'{band_edges[-1]}+']
+        tables['BonusMalus'] = self._table(self.segments['BonusMalus'], band_labels, 'BonusMalus')
+        tables['deciles'] = self.deciles()
+        tables['lift'] = self.lift()
+        return tables
+
+#%% streaming evaluation: chunks scored and accumulated in worker processes
+# worker state: each process loads the model once
+predictors = {}
+
+def init_worker(model_type: str, model_path: str):
+    predictors[model_type] = Predictor(CatBoostRegressor().load_model(model_path), model_type, thread_count=1)
+    return None
+
+def evaluate_chunk(chunk: pd.DataFrame, model_type: str, bonus_malus_bands: list) -> EvaluationAccumulator:
+    chunk = prepare_chunk(chunk, model_type)
+    return EvaluationAccumulator(model_type, bonus_malus_bands).add(chunk, predictors[model_type].predict(chunk))
+
+def evaluate_chunks(chunks, model_type: str, model_path: str, workers: int | None = None,
+                    bonus_malus_bands: list = default_bonus_malus_bands) -> EvaluationAccumulator:
+    # chunks: iterable of DataFrames (e.g. steps.chunks.read_chunks); memory holds at most two chunks per worker
+    workers = workers or os.cpu_count()
+    total = EvaluationAccumulator(model_type, bonus_malus_bands)
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(model_type, model_path)) as executor:
+        for chunk in chunks:
+            pending.append(executor.submit(evaluate_chunk, chunk, model_type, bonus_malus_bands))
+            if len(pending) >= 2 * workers:
+                total.merge(pending.popleft().result())
+        while pending:
+            total.merge(pending.popleft().result())
+    return total
+
+def save_tables(accumulator: EvaluationAccumulator, folder: str, prefix: str = '') -> list:
+    # one csv per table, named {prefix}{table}.csv; returns the paths
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for name, table in accumulator.tables().items():
+        path = os.path.join(folder, f'{prefix}{name}.csv')
+        table.to_csv(path, index=name != 'lift')
+        paths.append(path)
+    return paths
@@ -4,15 +4,53 @@ from pandas.core.frame import DataFrame
 import os
 from typing import Tuple
 import numpy as np
+from steps.dtypes import dtypes_list, categorical_factors
 
 #%% Ingestion class
 class Ingestion:
     def __init__(self):
         self.data_dir = "./data"
+        # typed columnar copies of the splits, keyed on the source file size and mtime
+        self.cache_dir = os.path.join(self.data_dir, "cache")
+        self._splits = {}
+
+    def _cache_path(self, file_name: str) -> str:
+        stat = os.stat(os.path.join(self.data_dir, file_name))
+        stem = os.path.splitext(file_name)[0]
+        return os.path.join(self.cache_dir, f'{stem}-{stat.st_size}-{stat.st_mtime_ns}.parquet')
+
+    def _read_split(self, file_name: str) -> DataFrame:
+        # typed partitions written by dataset.py --streaming are read as they are
+        partition_dir = os.path.join(self.data_dir, "partitions", os.path.splitext(file_name)[0])
+        if os.path.isdir(partition_dir):
+            return pd.read_parquet(partition_dir)
+        # parse the csv once into compact dtypes, then read the parquet copy until the csv changes
+        cache_path = self._cache_path(file_name)
+        if os.path.exists(cache_path):
+            return pd.read_parquet(cache_path)
+        df = pd.read_csv(os.path.join(self.data_dir, file_name), sep=";", dtype=dtypes_list)
+        for col in categorical_factors:
+            df[col] = df[col].astype('category')
+        os.makedirs(self.cache_dir, exist_ok=True)
+        stem = os.path.splitext(file_name)[0]
+        for stale in os.listdir(self.cache_dir):
+            stale_path = os.path.join(self.cache_dir, stale)
+            if stale.startswith(f'{stem}-') and stale.endswith('.parquet') and stale_path != cache_path:
+                try:
+                    os.remove(stale_path)
+                except FileNotFoundError:
+                    # removed meanwhile by another pipeline (e.g. the other model with training.parallel)
+                    pass
+        # written under a temporary name and renamed, as concurrent pipelines may share the cache
+        tmp_path = f'{cache_path}.{os.getpid()}.tmp'
+        df.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+        return df
 
     def _load_data(self, file_name: str, assign_func) -> DataFrame:
-        file_path = os.path.join(self.data_dir, file_name)
-        return pd.read_csv(file_path, sep=";").assign(**assign_func)
+        if file_name not in self._splits:
+            self._splits[file_name] = self._read_split(file_name)
+        return self._splits[file_name].assign(**assign_func)
 
     def load_freq(self) -> Tuple[DataFrame, DataFrame, DataFrame]:
         assign_func = {'log_exposure': lambda x: np.log(x['Exposure'])}
@@ -22,7 +60,7 @@ class Ingestion:
         return df_train, df_valid, df_test
 
     def load_severity(self) -> Tuple[DataFrame, DataFrame, DataFrame]:
-        assign_func = {'severity': lambda x: x.apply(lambda row: row['claims_cost'] / row['ClaimNb'] if row['ClaimNb'] > 0 else 0, axis=1)}
+        assign_func = {'severity': lambda x: x['claims_cost'].div(x['ClaimNb']).where(x['ClaimNb'] > 0, 0)}
         df_train = self._load_data('train.csv', assign_func)
         df_valid = self._load_data('valid.csv', assign_func)
         df_test = self._load_data('test.csv', assign_func)
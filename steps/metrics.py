@@ -0,0 +1,172 @@
+#%% import libraries
+import bisect
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+
+#%% metric types (Prometheus text exposition format)
+# latency buckets in seconds, from 50us to 2.5s
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+def _label_text(labelnames: tuple, labelvalues: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name: str, help: str, labelnames: tuple = ()):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labelvalues, amount: float = 1):
+        with self._lock:
+            self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def set(self, *labelvalues, value: float):
+        # also used to mirror counters kept by another component (e.g. QuoteCache) at scrape time
+        with self._lock:
+            self.values[labelvalues] = value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for labelvalues, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{_label_text(self.labelnames, labelvalues)} {value}')
+        return lines
+
+class Gauge(Counter):
+    def dec(self, *labelvalues, amount: float = 1):
+        self.inc(*labelvalues, amount=-amount)
+
+    def render(self) -> list[str]:
+        lines = super().render()
+        lines[1] = f'# TYPE {self.name} gauge'
+        return lines
+
+class Histogram:
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, labelnames
+        self.buckets = tuple(buckets)
+        # per label values: [bucket counts..., +Inf count], sum
+        self.counts = {}
+        self.sums = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self.counts.get(labelvalues)
+            if counts is None:
+                counts = self.counts[labelvalues] = [0] * (len(self.buckets) + 1)
+                self.sums[labelvalues] = 0.0
+            counts[index] += 1
+            self.sums[labelvalues] += value
+
+    def render(self) -> list[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for labelvalues, counts in sorted(self.counts.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_label_text(self.labelnames, labelvalues, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_label_text(self.labelnames, labelvalues)} {self.sums[labelvalues]}')
+            lines.append(f'{self.name}_count{_label_text(self.labelnames, labelvalues)} {cumulative}')
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return '\n'.join(line for metric in self.metrics for line in metric.render()) + '\n'
+
+#%% ASGI middleware
+# counts requests per path and status, tracks the requests in flight and times each request;
+# handlers that record scope['state']['handler_end'] (see app.handler_timer) also get the
+# time spent serializing their response until it is sent
+class MetricsMiddleware:
+    def __init__(self, app, requests: Counter, latency: Histogram, in_flight: Gauge, stages: Histogram, paths: set):
+        self.app = app
+        self.requests, self.latency, self.in_flight, self.stages = requests, latency, in_flight, stages
+        # known routes only, so that scans of random urls do not create new series
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        state = scope.setdefault('state', {})
+        state['metrics_start'] = start
+        status = 500
+
+        async def send_with_metrics(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                if 'handler_end' in state:
+                    self.stages.observe(time.perf_counter() - state['handler_end'], 'serialization')
+            await send(message)
+
+        self.in_flight.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            self.in_flight.dec()
+            path = scope['path'] if scope['path'] in self.paths else 'other'
+            self.requests.inc(path, str(status))
+            self.latency.observe(time.perf_counter() - start, path)
+
+#%% sampling profiler
+# a background thread samples the stacks of the other threads every interval_ms and counts
+# them in collapsed format (frame;frame;frame count), ready for flame graph tools;
+# nothing runs on the request path
+class StackSampler:
+    def __init__(self, interval_ms: float = 10.0, max_depth: int = 64):
+        self.interval = interval_ms / 1000
+        self.max_depth = max_depth
+        self.stacks = StackCounter()
+        self.samples = 0
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if not self.running:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+            self._thread.start()
+        return None
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        return None
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({code.co_filename}:{frame.f_lineno})')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        return '\n'.join(f'{stack} {count}' for stack, count in self.stacks.most_common()) + '\n'
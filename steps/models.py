@@ -0,0 +1,164 @@
+#%% import libraries
+import logging
+import os
+import threading
+import time
+from typing import NamedTuple
+import numpy as np
+import yaml
+from catboost import CatBoostRegressor
+from steps.cache import model_fingerprint
+from steps.predict import Predictor
+
+#%% model set
+# the frequency and severity models are always loaded, validated and swapped together,
+# so a request never scores a new frequency model with an old severity model
+class ModelSet(NamedTuple):
+    frequency: CatBoostRegressor
+    severity: CatBoostRegressor
+    version: str
+    paths: tuple
+    load_seconds: dict
+
+# record scored after loading, before the set is published
+probe = {'VehPower': 5, 'VehAge': 1, 'DrivAge': 35, 'Density': 100, 'BonusMalus': 100,
+         'VehBrand': 'B12', 'VehGas': 'Regular', 'Region': 'R11', 'Area': 'A'}
+
+def load_model_set(config_path: str = 'config.yml') -> ModelSet:
+    # model paths are read from the config at each load, so a reload can point to new files
+    with open(config_path, 'r') as file:
+        config = yaml.safe_load(file)
+    paths = {'frequency': config['models']['frequency'], 'severity': config['models']['severity']}
+    models, load_seconds = {}, {}
+    for model_type, path in paths.items():
+        start = time.perf_counter()
+        models[model_type] = CatBoostRegressor().load_model(path)
+        load_seconds[model_type] = time.perf_counter() - start
+    # one thread, as this may run in the parent process before the workers are forked
+    for model_type, model in models.items():
+        prediction = Predictor(model, model_type, thread_count=1).predict_fast(probe)
+        if not (np.all(np.isfinite(prediction)) and np.all(prediction > 0)):
+            raise ValueError(f'{model_type} model {paths[model_type]} returned {prediction} on the probe record')
+    return ModelSet(models['frequency'], models['severity'], model_fingerprint(*paths.values()), tuple(paths.values()), load_seconds)
+
+#%% memory of the current process
+def memory_usage() -> dict:
+    # resident memory split into pages shared with other processes (e.g. the models loaded
+    # before fork) and private ones; pss charges shared pages to each process pro rata
+    usage = {}
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as file:
+            for line in file:
+                key, _, value = line.partition(':')
+                if key in ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty'):
+                    usage[key] = int(value.split()[0]) * 1024
+    except OSError:
+        # not on Linux: resident memory only
+        import resource
+        return {'rss_bytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024}
+    return {'rss_bytes': usage['Rss'], 'pss_bytes': usage['Pss'],
+            'shared_bytes': usage['Shared_Clean'] + usage['Shared_Dirty'],
+            'private_bytes': usage['Private_Clean'] + usage['Private_Dirty']}
+
+#%% model store
+# holds the current model set: readers take store.current once per request and use both
+# models from it, reload builds a complete new set off to the side and publishes it with a
+# single reference assignment, so in-flight requests finish on the set they started with;
+# the generation file reaches the other worker processes: publish bumps it after a reload,
+# and the watcher of every process reloads when it differs from the generation it loaded
+class ModelStore:
+    def __init__(self, config_path: str = 'config.yml', generation_path: str | None = None):
+        self.config_path = config_path
+        self.generation_path = generation_path
+        self.generation = None
+        self.current = None
+        self.reloads = {'ok': 0, 'failed': 0}
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._stop = threading.Event()
+
+    def read_generation(self) -> str | None:
+        if self.generation_path is None:
+            return None
+        try:
+            with open(self.generation_path, 'r') as file:
+                return file.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def load(self) -> ModelSet:
+        # the generation is read before the models, so a bump during the load triggers another one
+        self.generation = self.read_generation()
+        self.current = load_model_set(self.config_path)
+        return self.current
+
+    def reload(self) -> dict:
+        # a failed load or validation leaves the current set serving
+        with self._lock:
+            before = memory_usage()
+            old_version = self.current.version if self.current is not None else None
+            generation = self.read_generation()
+            try:
+                model_set = load_model_set(self.config_path)
+            except Exception:
+                self.reloads['failed'] += 1
+                raise
+            self.current, self.generation = model_set, generation
+            self.reloads['ok'] += 1
+            logging.info(f'Models reloaded in process {os.getpid()}: {old_version} -> {model_set.version}')
+            return {'pid': os.getpid(), 'old_version': old_version, 'new_version': model_set.version,
+                    'memory_before': before, 'memory_after': memory_usage()}
+
+    def publish(self) -> dict:
+        # reloads this process, then bumps the generation file for the other processes (only once
+        # the models loaded and passed the probe, so a broken model is not pushed to every worker)
+        result = self.reload()
+        if self.generation_path is not None:
+            with self._lock:
+                generation = f'{time.time_ns()}-{os.getpid()}'
+                tmp_path = f'{self.generation_path}.{os.getpid()}.tmp'
+                with open(tmp_path, 'w') as file:
+                    file.write(generation)
+                os.replace(tmp_path, self.generation_path)
+                self.generation = generation
+        return {**result, 'generation': self.generation}
+
+    def _signature(self) -> tuple:
+        # config and model files as last seen; a change in any of them triggers a reload
+        paths = (self.config_path,) + (self.current.paths if self.current is not None else ())
+        signature = []
+        for path in paths:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def watch(self, interval_s: float = 5.0, files: bool = True):
+        # polls the generation file, and with files the config and model files, on a daemon thread;
+        # each worker process watches on its own
+        def run(seen):
+            while not self._stop.wait(interval_s):
+                signature = self._signature() if files else None
+                if signature != seen or self.read_generation() != self.generation:
+                    try:
+                        self.reload()
+                        seen = self._signature() if files else None
+                    except Exception:
+                        # e.g. a model file still being copied: retried once the files change again
+                        logging.exception('Model reload failed, still serving the previous models')
+                        seen = signature
+
+        if self._watcher is None:
+            self._stop.clear()
+            self._watcher = threading.Thread(target=run, args=(self._signature() if files else None,), name='model-watcher', daemon=True)
+            self._watcher.start()
+        return None
+
+    def stop(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+        return None
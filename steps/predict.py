@@ -1,18 +1,38 @@
 #%% Importing necessary libraries
-import pandas as pd
 import numpy as np
-from catboost import CatBoostRegressor, Pool
-from typing import Literal
+import time
+from typing import Literal, TYPE_CHECKING
+from steps.cache import QuoteCache
+from steps.compiled import CompiledModel
+# pandas and catboost are imported when first needed, so that serving the compiled
+# models (serve.py) starts without them
+if TYPE_CHECKING:
+    import pandas as pd
+    from catboost import CatBoostRegressor, Pool
 
 #%% predictor class
 class Predictor:
-    def __init__(self,  model: CatBoostRegressor, model_type=Literal['frequency','severity']):
+    def __init__(self,  model: 'CatBoostRegressor | CompiledModel', model_type=Literal['frequency','severity'], cache: QuoteCache | None = None, model_version: str = '', thread_count: int = -1, stage_hook=None):
         self.model = model
         self.model_type = model_type
+        # optional quote cache, keyed on the model version (see steps.cache.model_fingerprint)
+        self.cache = cache
+        self.model_version = model_version
+        # CPU threads used by CatBoost for each prediction call (-1 uses all cores)
+        self.thread_count = thread_count
         self.cat_features = ['VehBrand', 'VehGas', 'Region','Area']
         self.numeric_features = ['VehPower', 'VehAge', 'DrivAge', 'Density', 'BonusMalus']
+        # fast path layout: models are trained on the numeric block followed by the
+        # categorical block (see Trainer.create_pools), tuples follow the same order
+        self.n_numeric = len(self.numeric_features)
+        # NumPy backend exported from the CatBoost model (see steps/compiled.py)
+        self.compiled = isinstance(model, CompiledModel)
+        # optional callable(stage, seconds) timing features, create_pool and inference (see app.py /metrics)
+        self.stage_hook = stage_hook
     
-    def create_pool(self, data: pd.DataFrame | dict) -> Pool:
+    def create_pool(self, data: 'pd.DataFrame | dict') -> 'Pool':
+        import pandas as pd
+        from catboost import Pool
         if isinstance(data, dict):
             data = pd.DataFrame([data])
             # add fictitious exposure column if it does not exist
@@ -32,6 +52,111 @@ class Predictor:
                         cat_features=self.cat_features, weight=data['ClaimNb'])
         return pool
     
-    def predict(self, data: pd.DataFrame) -> np.array:
-        pool = self.create_pool(data)
-        return self.model.predict(pool)
\ No newline at end of file
+    def _observe(self, stage: str, start: float) -> float:
+        now = time.perf_counter()
+        if self.stage_hook is not None:
+            self.stage_hook(stage, now - start)
+        return now
+
+    def predict(self, data: 'pd.DataFrame') -> np.array:
+        start = time.perf_counter()
+        if self.compiled:
+            baseline = data['log_exposure'].to_numpy() if self.model_type == 'frequency' else None
+            num, cat = data[self.numeric_features].to_numpy(dtype=np.float32), data[self.cat_features].astype(str).to_numpy()
+            start = self._observe('features', start)
+            predictions = self.model.predict(num, cat, baseline)
+        else:
+            pool = self.create_pool(data)
+            start = self._observe('create_pool', start)
+            predictions = self.model.predict(pool, thread_count=self.thread_count)
+        self._observe('inference', start)
+        return predictions
+
+    def _log_exposure(self, row: dict) -> float:
+        if 'log_exposure' in row:
+            return row['log_exposure']
+        if 'Exposure' in row:
+            return np.log(row['Exposure'])
+        return 0.0
+
+    def _fast_features(self, data: dict | tuple | list | np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # numpy record array: whole columns at once
+        if isinstance(data, np.ndarray):
+            num = np.column_stack([data[f] for f in self.numeric_features]).astype(np.float32)
+            cat = np.column_stack([data[f].astype(str).astype(object) for f in self.cat_features])
+            if 'log_exposure' in data.dtype.names:
+                log_exposure = data['log_exposure'].astype(np.float64)
+            elif 'Exposure' in data.dtype.names:
+                log_exposure = np.log(data['Exposure'].astype(np.float64))
+            else:
+                log_exposure = np.zeros(len(data))
+            return num, cat, log_exposure
+
+        # a single dict or tuple, or a list of them
+        rows = data if isinstance(data, list) else [data]
+        num = np.empty((len(rows), self.n_numeric), dtype=np.float32)
+        cat = np.empty((len(rows), len(self.cat_features)), dtype=object)
+        log_exposure = np.zeros(len(rows))
+        for i, row in enumerate(rows):
+            if isinstance(row, dict):
+                num[i] = [row[f] for f in self.numeric_features]
+                cat[i] = [str(row[f]) for f in self.cat_features]
+                log_exposure[i] = self._log_exposure(row)
+            else:
+                num[i] = row[:self.n_numeric]
+                cat[i] = [str(value) for value in row[self.n_numeric:]]
+        return num, cat, log_exposure
+
+    def predict_fast(self, data: dict | tuple | list | np.ndarray) -> np.array:
+        # scores dicts, tuples or a numpy record array without building a DataFrame or a Pool,
+        # with the same output as predict on the equivalent DataFrame
+        start = time.perf_counter()
+        num, cat, log_exposure = self._fast_features(data)
+        start = self._observe('features', start)
+        if self.compiled:
+            predictions = self.model.predict(num, cat, log_exposure if self.model_type == 'frequency' else None)
+        else:
+            from catboost import Pool, FeaturesData
+            features = FeaturesData(num_feature_data=num, cat_feature_data=cat)
+            if self.model_type == 'frequency' and np.any(log_exposure != 0):
+                # exposure enters the Poisson model as a baseline on the log scale
+                features = Pool(data=features, baseline=log_exposure)
+            start = self._observe('create_pool', start)
+            predictions = self.model.predict(features, thread_count=self.thread_count)
+        self._observe('inference', start)
+        return predictions
+
+    def _cache_key(self, row: dict) -> tuple:
+        # normalized rating factors, so that e.g. 7 and 7.0 share an entry; the exposure only
+        # enters the frequency model, severity quotes share an entry whatever their exposure
+        factors = tuple(float(row[f]) for f in self.numeric_features) + tuple(str(row[f]) for f in self.cat_features)
+        log_exposure = float(self._log_exposure(row)) if self.model_type == 'frequency' else 0.0
+        return self.model_version, self.model_type, factors, log_exposure
+
+    def cached(self, row: dict) -> float | None:
+        # cached prediction for a single record, None on a miss or without a cache
+        if self.cache is None:
+            return None
+        return self.cache.get(self._cache_key(row))
+
+    def predict_cached(self, data: dict | list[dict], lookup: bool = True) -> np.array:
+        # predict_fast through the quote cache: only the misses are scored, in one call;
+        # lookup=False scores everything and refreshes the cache (records already looked up)
+        if self.cache is None:
+            return self.predict_fast(data)
+        rows = data if isinstance(data, list) else [data]
+        keys = [self._cache_key(row) for row in rows]
+        predictions = np.empty(len(rows))
+        missing = []
+        for i, key in enumerate(keys):
+            value = self.cache.get(key) if lookup else None
+            if value is None:
+                missing.append(i)
+            else:
+                predictions[i] = value
+        if missing:
+            scored = self.predict_fast([rows[i] for i in missing])
+            for i, value in zip(missing, scored):
+                predictions[i] = value
+                self.cache.put(keys[i], value)
+        return predictions
@@ -0,0 +1,9 @@
+#%% commercial premium
+def compute_commercial_premium(pure_premium, expenses)-> float:
+    # loads the pure premium with fixed expenses, then variable expenses and taxes;
+    # works on scalars as well as numpy arrays / pandas series
+    numerator = pure_premium + expenses.get('FixedExpenses', 0)
+    denominator  = 1 - expenses.get('VariableExpenses', 0) - expenses.get('TaxRate', 0)
+    commercial_premium = numerator / denominator
+
+    return commercial_premium
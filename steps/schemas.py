@@ -0,0 +1,32 @@
+#%% import libraries
+from pydantic import BaseModel, Field
+from typing import Literal
+
+#%% request and response schemas shared by app.py and serve.py
+# Input schema for the insured person
+class Insured(BaseModel):
+    VehPower: int = Field(title='Vehicle Power', description='Vehicle power in CV', ge=1, le=20, default=5)
+    VehAge: int = Field(title='Vehicle Age', description='Vehicle age in years', ge=0, le=120, default=1)
+    DrivAge: int = Field(title='Driver Age', description='Driver age in years', ge=18, le=120, default=35)
+    Density: int = Field(title='Density', description='Density of inhabitants per km2', gt=0, le=30000, default=100)
+    BonusMalus: int = Field(title='Bonus Malus', description='Bonus Malus', ge=50, le=230, default=100)
+    VehBrand: Literal['B12', 'B3', 'B2', 'B5', 'B4', 'B6', 'B10', 'B1', 'B13', 'B11', 'B14'] = Field(title='Vehicle Brand', description='Vehicle brand as per allowed values')
+    VehGas: Literal['Regular', 'Diesel'] = Field(title='Vehicle Gas', description='Vehicle gas as per allowed values')
+    Region: Literal['R72', 'R91', 'R52', 'R11', 'R94', 'R93', 'R31', 'R82', 'R22', 'R21', 'R42', 'R54', 'R73', 'R41', 'R26', 'R25', 'R24', 'R53', 'R83', 'R23', 'R74', 'R43'] = Field(title='Region', description='Region code as per allowed values')
+    Area: Literal['A', 'B', 'C', 'D', 'E', 'F', 'G'] = Field(title='Area', description='Area code as per allowed values')
+
+# Input schema for a batch of insured persons, with optional exposure per record
+class BatchInsured(Insured):
+    Exposure: float = Field(title='Exposure', description='Exposure in years', gt=0, default=1.0)
+
+# Output schema for prediction response
+class PredictionResponse(BaseModel):
+    Frequency: float
+    Severity: float
+    Pure_Premium: float
+
+# Output schema for batch prediction response, in input order
+class BatchPredictionResponse(BaseModel):
+    Frequency: list[float]
+    Severity: list[float]
+    Pure_Premium: list[float]
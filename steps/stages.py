@@ -0,0 +1,75 @@
+#%% import libraries
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import shutil
+import time
+import pandas as pd
+
+#%% content hash of stage inputs
+def digest(*inputs) -> str:
+    # DataFrames by content, functions and modules by source code, anything else by its json (or repr)
+    hasher = hashlib.sha256()
+    for value in inputs:
+        if isinstance(value, pd.DataFrame):
+            hasher.update(repr(list(value.columns)).encode())
+            hasher.update(pd.util.hash_pandas_object(value, index=False).to_numpy().tobytes())
+        elif callable(value) or inspect.ismodule(value):
+            hasher.update(inspect.getsource(value).encode())
+        else:
+            hasher.update(json.dumps(value, sort_keys=True, default=repr).encode())
+    return hasher.hexdigest()[:16]
+
+#%% stage cache
+# outputs of the pipeline stages stored under {cache_dir}/{stage}-{key}: the pickled return
+# value and copies of the files the stage writes, restored on a hit; a stage is only
+# recomputed when the hash of its inputs changes (or with force)
+class StageCache:
+    def __init__(self, cache_dir: str | None, force: bool = False, label: str = ''):
+        self.cache_dir = cache_dir
+        self.force = force
+        self.label = label
+        # seconds and cache hit of each stage, e.g. {'train_s': 12.3, 'train_cache_hit': 0}
+        self.summary = {}
+
+    def run(self, name: str, key: str, compute, files: tuple = ()):
+        start = time.perf_counter()
+        folder = os.path.join(self.cache_dir, f'{name}-{key}') if self.cache_dir else None
+        hit = folder is not None and not self.force and os.path.exists(os.path.join(folder, 'result.pkl'))
+        if hit:
+            with open(os.path.join(folder, 'result.pkl'), 'rb') as file:
+                result = pickle.load(file)
+            for path in files:
+                shutil.copy2(os.path.join(folder, os.path.basename(path)), path)
+        else:
+            result = compute()
+            if folder is not None:
+                self._store(folder, result, files)
+        self.record(name, time.perf_counter() - start, hit)
+        return result
+
+    def record(self, name: str, seconds: float, hit: bool = False):
+        self.summary[f'{name}_s'] = seconds
+        self.summary[f'{name}_cache_hit'] = int(hit)
+        logging.info(f'{self.label}stage {name}: {"cache hit" if hit else "computed"} in {seconds:.2f}s')
+        return None
+
+    def _store(self, folder: str, result, files: tuple):
+        # written to a temporary folder and renamed, as concurrent pipelines may share the cache
+        tmp_folder = f'{folder}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        os.makedirs(tmp_folder)
+        for path in files:
+            shutil.copy2(path, os.path.join(tmp_folder, os.path.basename(path)))
+        with open(os.path.join(tmp_folder, 'result.pkl'), 'wb') as file:
+            pickle.dump(result, file)
+        shutil.rmtree(folder, ignore_errors=True)
+        try:
+            os.replace(tmp_folder, folder)
+        except OSError:
+            # stored meanwhile by another pipeline, with the same inputs
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        return None
@@ -1,12 +1,65 @@
 #%% import libraries
 import pandas as pd
 import numpy as np
+import os
+import time
+import hashlib
+import catboost
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from sklearn.metrics import mean_poisson_deviance, root_mean_squared_error
-from catboost import CatBoostRegressor, Pool
+from catboost import CatBoostRegressor, Pool, sum_models
 from catboost.utils import get_gpu_device_count
+
+#%% quantized pools on disk
+def load_quantized_pools(folder: str, model_type: str) -> tuple[Pool, Pool]:
+    train_pool = Pool(f"quantized://{os.path.join(folder, 'train.qbin')}")
+    val_pool = Pool(f"quantized://{os.path.join(folder, 'val.qbin')}")
+    # the baseline does not round trip through the quantized format, it is stored next to it
+    if model_type == 'frequency':
+        train_pool.set_baseline(np.load(os.path.join(folder, 'train_baseline.npy')))
+        val_pool.set_baseline(np.load(os.path.join(folder, 'val_baseline.npy')))
+    return train_pool, val_pool
+
+#%% hyperparameter search trials, run in worker processes
+# pools loaded by a worker, by folder (one per border count), reused by all its trials
+_trial_pools = {}
+
+class MedianPruner:
+    # CatBoost callback: stops a trial whose best validation loss so far is above the median of the
+    # completed trials at the same iteration, checked every interval iterations after warmup
+    def __init__(self, curves: list, warmup: int = 100, interval: int = 50, min_trials: int = 4):
+        self.curves = curves
+        self.warmup = warmup
+        self.interval = interval
+        self.min_trials = min_trials
+        self.pruned = False
+
+    def after_iteration(self, info) -> bool:
+        curve = next(iter(info.metrics['validation'].values()))
+        n = len(curve)
+        if n < self.warmup or n % self.interval or len(self.curves) < self.min_trials:
+            return True
+        self.pruned = min(curve) > np.median([np.min(other[:n]) for other in self.curves])
+        return not self.pruned
+
+def run_trial(folder: str, model_type: str, params: dict, thread_count: int, iterations: int, curves: list, pruning: dict) -> dict:
+    if folder not in _trial_pools:
+        _trial_pools[folder] = load_quantized_pools(folder, model_type)
+    train_pool, val_pool = _trial_pools[folder]
+    pruner = MedianPruner(curves, **pruning)
+    # the border count is the one of the quantized pools; trials run on CPU, as callbacks need it
+    model = CatBoostRegressor(loss_function='Poisson' if model_type == 'frequency' else 'RMSE', iterations=iterations, thread_count=thread_count,
+                              **{name: value for name, value in params.items() if name != 'border_count'})
+    start = time.perf_counter()
+    model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50, verbose=False, callbacks=[pruner])
+    fit_s = time.perf_counter() - start
+    curve = next(iter(model.get_evals_result()['validation'].values()))
+    return {'params': params, 'best_score': float(np.min(curve)), 'best_iteration': int(np.argmin(curve)), 'curve': [float(value) for value in curve],
+            'pruned': pruner.pruned, 'fit_s': fit_s}
+
 #%% trainer class
 class Trainer:
-    def __init__(self, train_data: pd.DataFrame, val_data: pd.DataFrame, test_data:pd.DataFrame, target: str, model_type='frequency'):
+    def __init__(self, train_data: pd.DataFrame, val_data: pd.DataFrame, test_data:pd.DataFrame, target: str, model_type='frequency', pool_cache_dir: str | None = None, thread_count: int = -1, params: dict | None = None):
         self.train_data = train_data
         self.val_data = val_data
         self.test_data = test_data
@@ -16,42 +69,179 @@ class Trainer:
         self.numeric_features = ['VehPower', 'VehAge', 'DrivAge', 'Density', 'BonusMalus']
         # check GPU availability
         self.gpu_available = get_gpu_device_count() > 0
+        # optional on-disk cache of quantized pools and per-stage timings (seconds)
+        self.pool_cache_dir = pool_cache_dir
+        # CPU threads for CatBoost (-1 uses all cores)
+        self.thread_count = thread_count
+        # tuned CatBoost parameters (depth, learning_rate, l2_leaf_reg, border_count), see tune
+        self.params = params or {}
+        self.timings = {}
+        self._pools = None
     
     def _ap_ratio(self, actual, predicted) -> float: 
         return np.sum(actual) / np.sum(predicted)
 
 
-    def create_pools(self) -> tuple[Pool, Pool, Pool]:
+    def _build_pool(self, data: pd.DataFrame) -> Pool:
         features = self.numeric_features + self.cat_features
         if self.model_type == 'frequency':
-            train_pool = Pool(data=self.train_data.filter(items=features), 
-                            label=self.train_data[self.target], 
-                            cat_features=self.cat_features, baseline=self.train_data['log_exposure'])
-            val_pool = Pool(data=self.val_data.filter(items=features), 
-                            label=self.val_data[self.target], 
-                            cat_features=self.cat_features, baseline=self.val_data['log_exposure'])
-            test_pool = Pool(data=self.test_data.filter(items=features), 
-                            label=self.test_data[self.target], 
-                            cat_features=self.cat_features, baseline=self.test_data['log_exposure'])
-        else:
-            train_pool = Pool(data=self.train_data.filter(items=features), 
-                            label=self.train_data[self.target], 
-                            cat_features=self.cat_features, weight=self.train_data['ClaimNb'])
-            val_pool = Pool(data=self.val_data.filter(items=features), 
-                            label=self.val_data[self.target], 
-                            cat_features=self.cat_features, weight=self.val_data['ClaimNb'])
-            test_pool = Pool(data=self.test_data.filter(items=features), 
-                            label=self.test_data[self.target], 
-                            cat_features=self.cat_features, weight=self.test_data['ClaimNb'])
-        return train_pool, val_pool, test_pool
+            return Pool(data=data.filter(items=features), 
+                        label=data[self.target], 
+                        cat_features=self.cat_features, baseline=data['log_exposure'])
+        return Pool(data=data.filter(items=features), 
+                    label=data[self.target], 
+                    cat_features=self.cat_features, weight=data['ClaimNb'])
+
+    def row_hashes(self, data: pd.DataFrame) -> np.ndarray:
+        # one hash per row of the modelling columns: a changed row hashes as a new one
+        columns = self.numeric_features + self.cat_features + [self.target, 'log_exposure', 'ClaimNb']
+        return pd.util.hash_pandas_object(data.filter(items=columns), index=False).to_numpy()
+
+    def _pool_key(self) -> str:
+        # hash of the training and validation data and of the pool configuration
+        columns = self.numeric_features + self.cat_features + [self.target, 'log_exposure', 'ClaimNb']
+        digest = hashlib.sha256()
+        for data in (self.train_data, self.val_data):
+            digest.update(pd.util.hash_pandas_object(data.filter(items=columns), index=False).to_numpy().tobytes())
+        digest.update(repr((self.model_type, self.target, self.numeric_features, self.cat_features, catboost.__version__)).encode())
+        return digest.hexdigest()[:16]
+
+    def _pool_folder(self, border_count: int | None = None) -> str:
+        suffix = '' if border_count is None else f'-borders{border_count}'
+        return os.path.join(self.pool_cache_dir, f'{self.model_type}-{self._pool_key()}{suffix}')
+
+    def _quantized_pools(self, border_count: int | None = None) -> tuple[Pool, Pool]:
+        # quantized train/val pools persisted on disk, reused while data and configuration are unchanged
+        folder = self._pool_folder(border_count)
+        paths = {name: os.path.join(folder, f'{name}.qbin') for name in ('train', 'val')}
+        baselines = {name: os.path.join(folder, f'{name}_baseline.npy') for name in ('train', 'val')}
+        if os.path.exists(paths['val']):
+            self.timings['pool_cache_hit'] = 1
+            return load_quantized_pools(folder, self.model_type)
+
+        self.timings['pool_cache_hit'] = 0
+        train_pool = self._build_pool(self.train_data)
+        val_pool = self._build_pool(self.val_data)
+        os.makedirs(folder, exist_ok=True)
+        borders = os.path.join(folder, 'borders.tsv')
+        train_pool.quantize(**({} if border_count is None else {'border_count': border_count}))
+        train_pool.save_quantization_borders(borders)
+        val_pool.quantize(input_borders=borders)
+        if self.model_type == 'frequency':
+            np.save(baselines['train'], np.asarray(train_pool.get_baseline()))
+            np.save(baselines['val'], np.asarray(val_pool.get_baseline()))
+        # the validation pool is written last and marks a complete entry
+        train_pool.save(paths['train'])
+        val_pool.save(paths['val'])
+        return train_pool, val_pool
+
+    def create_pools(self) -> tuple[Pool, Pool, Pool]:
+        # built once per run: main.py and train_model both ask for the pools
+        if self._pools is None:
+            start = time.perf_counter()
+            if self.pool_cache_dir is None:
+                train_pool, val_pool = self._build_pool(self.train_data), self._build_pool(self.val_data)
+            else:
+                train_pool, val_pool = self._quantized_pools(self.params.get('border_count'))
+            # the test pool stays raw, as predictions need the categorical values
+            self._pools = train_pool, val_pool, self._build_pool(self.test_data)
+            self.timings['create_pools_s'] = time.perf_counter() - start
+        return self._pools
 
     def train_model(self) -> CatBoostRegressor:
         train_pool, val_pool, _ = self.create_pools()
         model_task = 'GPU' if self.gpu_available else 'CPU'
-        model = CatBoostRegressor(loss_function='Poisson' if self.model_type == 'frequency' else 'RMSE', task_type=model_task, iterations=2000)
+        # with quantized pools the border count is already in the pools
+        params = {name: value for name, value in self.params.items() if not (name == 'border_count' and self.pool_cache_dir is not None)}
+        model = CatBoostRegressor(loss_function='Poisson' if self.model_type == 'frequency' else 'RMSE', task_type=model_task, iterations=2000, thread_count=self.thread_count, **params)
+        start = time.perf_counter()
         model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50, verbose=100)  
+        self.timings['fit_s'] = time.perf_counter() - start
+        # kept in the saved model for train_incremental (summed models have no training parameters)
+        model.get_metadata()['learning_rate'] = str(model.get_all_params()['learning_rate'])
         return model
     
+    def train_incremental(self, init_model_path: str, iterations: int) -> CatBoostRegressor:
+        # continues boosting the model at init_model_path on the training data, with the parameters of
+        # train_model at the learning rate of the model; raw pools, as the quantized ones have their own borders
+        init_model = CatBoostRegressor().load_model(init_model_path)
+        metadata = init_model.get_metadata()
+        if 'learning_rate' in metadata:
+            learning_rate = float(metadata['learning_rate'])
+        else:
+            # models saved before the learning rate was kept in their metadata
+            learning_rate = self.params.get('learning_rate') or init_model.get_all_params()['learning_rate']
+        start = time.perf_counter()
+        train_pool, val_pool = self._build_pool(self.train_data), self._build_pool(self.val_data)
+        self.timings['create_pools_s'] = time.perf_counter() - start
+        model_task = 'GPU' if self.gpu_available else 'CPU'
+        params = {**self.params, 'learning_rate': learning_rate}
+        model = CatBoostRegressor(loss_function='Poisson' if self.model_type == 'frequency' else 'RMSE', task_type=model_task, iterations=iterations,
+                                  thread_count=self.thread_count, **params)
+        start = time.perf_counter()
+        if self.model_type == 'frequency':
+            # CatBoost does not continue training with a baseline: the log exposure plus the formula value
+            # of the current trees become the baseline of the new trees, then the two models are summed
+            train_pool.set_baseline(init_model.predict(train_pool, prediction_type='RawFormulaVal'))
+            val_pool.set_baseline(init_model.predict(val_pool, prediction_type='RawFormulaVal'))
+            model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50, verbose=100)
+            model = sum_models([init_model, model])
+            # the sum keeps no training parameters, the loss function sets the prediction type
+            model.get_metadata()['params'] = init_model.get_metadata()['params']
+        else:
+            model.fit(train_pool, eval_set=val_pool, early_stopping_rounds=50, verbose=100, init_model=init_model)
+        self.timings['fit_s'] = time.perf_counter() - start
+        model.get_metadata()['learning_rate'] = str(learning_rate)
+        return model
+
+    def _sample(self, rng: np.random.Generator, search_space: dict) -> dict:
+        # search_space: {parameter: {'int': [low, high]} | {'log': [low, high]} | {'choice': [values]}}
+        params = {}
+        for name, space in search_space.items():
+            kind, values = next(iter(space.items()))
+            if kind == 'int':
+                params[name] = int(rng.integers(values[0], values[1] + 1))
+            elif kind == 'log':
+                params[name] = float(np.exp(rng.uniform(np.log(values[0]), np.log(values[1]))))
+            elif kind == 'choice':
+                params[name] = values[int(rng.integers(len(values)))]
+            else:
+                raise ValueError(f'Unknown search space {kind} for {name}')
+        return params
+
+    def tune(self, trials: int, search_space: dict, workers: int | None = None, thread_count: int = 1, iterations: int = 2000,
+             pruning: dict | None = None, seed: int = 0, on_trial=None) -> dict:
+        # random search: trials run in a pool of worker processes (by default as many as the machine fits
+        # with thread_count CatBoost threads each), the next trial is pruned against the completed ones;
+        # on_trial is called in this process with the result of each trial, the best one is returned
+        if self.pool_cache_dir is None:
+            raise ValueError('Tuning reads the quantized pools from pool_cache_dir, which is not set')
+        rng = np.random.default_rng(seed)
+        candidates = [self._sample(rng, search_space) for _ in range(trials)]
+        # one quantized train/val pool per border count, written here once and loaded once per worker
+        folders = {}
+        for border_count in {params.get('border_count') for params in candidates}:
+            self._quantized_pools(border_count)
+            folders[border_count] = self._pool_folder(border_count)
+        workers = workers or max(1, (os.cpu_count() or 1) // thread_count)
+        queue, pending, curves, results = list(enumerate(candidates)), {}, [], []
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            while queue or pending:
+                while queue and len(pending) < workers:
+                    number, params = queue.pop(0)
+                    future = executor.submit(run_trial, folders[params.get('border_count')], self.model_type, params, thread_count,
+                                             iterations, list(curves), pruning or {})
+                    pending[future] = number
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    result = {'trial': pending.pop(future), **future.result()}
+                    results.append(result)
+                    if not result['pruned']:
+                        curves.append(result['curve'])
+                    if on_trial is not None:
+                        on_trial(result)
+        return min(results, key=lambda result: result['best_score'])
+
     def evaluate_model(self, model: CatBoostRegressor, pool: Pool) -> tuple[float, float]:
         predicted_values = model.predict(pool)
         actual_values = pool.get_label()
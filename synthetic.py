@@ -0,0 +1,108 @@
+#%% Importing libraries
+import argparse
+import io
+import os
+import zipfile
+import numpy as np
+import pandas as pd
+from steps.dtypes import dtypes_list, categorical_factors
+
+#%% synthetic French MTPL portfolio
+# same columns, category levels and dtypes as data/french_mtpl.zip, with marginals close to
+# freMTPL2: claim counts are Poisson on the exposure with a log-linear frequency, claim costs
+# are lognormal with a Pareto tail; rows are generated in fixed blocks seeded by (seed, block),
+# so a portfolio depends on seed and number of rows only
+columns = ['IDpol', 'ClaimNb', 'Exposure', 'Area', 'VehPower', 'VehAge', 'DrivAge', 'BonusMalus',
+           'VehBrand', 'VehGas', 'Density', 'Region', 'claims_cost']
+block_rows = 100_000
+
+levels = {
+    'Area': {'A': 0.15, 'B': 0.11, 'C': 0.28, 'D': 0.22, 'E': 0.21, 'F': 0.03},
+    'VehBrand': {'B1': 0.24, 'B2': 0.24, 'B12': 0.24, 'B3': 0.08, 'B5': 0.05, 'B6': 0.04, 'B4': 0.04,
+                 'B10': 0.03, 'B11': 0.02, 'B13': 0.02, 'B14': 0.01},
+    'VehGas': {'Regular': 0.51, 'Diesel': 0.49},
+    'Region': {'R24': 0.24, 'R82': 0.12, 'R93': 0.12, 'R11': 0.10, 'R53': 0.06, 'R52': 0.056, 'R91': 0.053,
+               'R72': 0.046, 'R31': 0.04, 'R54': 0.028, 'R73': 0.025, 'R41': 0.019, 'R25': 0.016, 'R26': 0.016,
+               'R23': 0.013, 'R22': 0.012, 'R83': 0.008, 'R74': 0.007, 'R94': 0.007, 'R21': 0.004, 'R42': 0.003, 'R43': 0.002},
+}
+veh_power = {4: 0.17, 5: 0.19, 6: 0.22, 7: 0.21, 8: 0.07, 9: 0.04, 10: 0.05, 11: 0.03, 12: 0.01, 13: 0.004, 14: 0.003, 15: 0.003}
+# log density (inhabitants per km2) by area, the areas being density classes
+area_log_density = {'A': 3.4, 'B': 4.4, 'C': 5.4, 'D': 6.5, 'E': 7.8, 'F': 9.6}
+
+# true log-frequency of the generator: fixed effects of brand and region drawn once
+_effects = np.random.default_rng(2024)
+brand_effect = dict(zip(levels['VehBrand'], _effects.normal(0, 0.1, len(levels['VehBrand']))))
+region_effect = dict(zip(levels['Region'], _effects.normal(0, 0.1, len(levels['Region']))))
+
+def _draw(rng: np.random.Generator, probabilities: dict, n: int) -> np.ndarray:
+    p = np.array(list(probabilities.values()), dtype=float)
+    return np.array(list(probabilities))[rng.choice(len(p), size=n, p=p / p.sum())]
+
+def _block(block: int, n: int, seed: int) -> pd.DataFrame:
+    rng = np.random.default_rng([seed, block])
+    area = _draw(rng, levels['Area'], n)
+    density = np.exp(np.array([area_log_density[a] for a in area]) + rng.normal(0, 0.6, n))
+    drivage = np.clip(18 + rng.gamma(4.5, 6.1, n), 18, 100).astype(int)
+    # bonus malus: 50 for most experienced drivers, close to 100 for new ones
+    young = drivage < 25
+    bonus_malus = np.where(rng.random(n) < np.clip((drivage - 18) / 20, 0.05, 0.7), 50, 50 + rng.gamma(2, 12, n))
+    bonus_malus = np.where(young, 90 + rng.gamma(1.5, 8, n), bonus_malus)
+    df = pd.DataFrame({
+        'IDpol': block * block_rows + 1 + np.arange(n),
+        'Exposure': np.where(rng.random(n) < 0.27, 1.0, np.round(rng.uniform(0.0027, 1.0, n), 3)),
+        'Area': area,
+        'VehPower': _draw(rng, veh_power, n).astype(int),
+        'VehAge': np.clip(np.floor(rng.gamma(2, 3.5, n)), 0, 100).astype(int),
+        'DrivAge': drivage,
+        'BonusMalus': np.clip(np.round(bonus_malus), 50, 230).astype(int),
+        'VehBrand': _draw(rng, levels['VehBrand'], n),
+        'VehGas': _draw(rng, levels['VehGas'], n),
+        'Density': np.clip(np.round(density), 1, 27000).astype(int),
+        'Region': _draw(rng, levels['Region'], n),
+    })
+
+    # claim counts: Poisson with mean exposure x frequency
+    log_frequency = (np.log(0.07) + 0.012 * (df['BonusMalus'] - 50) + 0.6 * np.exp(-(df['DrivAge'] - 18) / 5)
+                     + 0.08 * (np.log(df['Density']) - 6) + 0.03 * (df['VehPower'] - 6) - 0.015 * df['VehAge']
+                     + 0.05 * (df['VehGas'] == 'Diesel') + df['VehBrand'].map(brand_effect) + df['Region'].map(region_effect))
+    df['ClaimNb'] = rng.poisson(df['Exposure'] * np.exp(log_frequency))
+    # claim costs: lognormal body with a median around 1,100, 2% of claims from a Pareto tail
+    n_claims = int(df['ClaimNb'].sum())
+    costs = rng.lognormal(7.0, 1.0, n_claims)
+    large = rng.random(n_claims) < 0.02
+    costs[large] = 10_000 * (1 + rng.pareto(1.5, int(large.sum())))
+    policy = np.repeat(np.arange(n), df['ClaimNb'])
+    df['claims_cost'] = np.round(np.bincount(policy, weights=costs, minlength=n), 2)
+    return df[columns]
+
+def iter_portfolio(n_rows: int, seed: int = 0):
+    # blocks of at most block_rows rows, typed as in steps/ingest.py
+    for block in range((n_rows + block_rows - 1) // block_rows):
+        df = _block(block, min(block_rows, n_rows - block * block_rows), seed)
+        df = df.astype({col: dtype for col, dtype in dtypes_list.items() if col in df.columns})
+        for col in categorical_factors:
+            df[col] = df[col].astype('category')
+        yield df
+
+def generate_portfolio(n_rows: int, seed: int = 0) -> pd.DataFrame:
+    return pd.concat(iter_portfolio(n_rows, seed), ignore_index=True)
+
+def save_portfolio(path: str, n_rows: int, seed: int = 0):
+    # csv with the separator of the original data, zipped when the path ends with .zip;
+    # written block by block, so memory does not grow with the number of rows
+    member = os.path.splitext(os.path.basename(path))[0] + '.csv'
+    with (zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) if path.endswith('.zip') else open(path, 'wb')) as target:
+        with (target.open(member, 'w') if path.endswith('.zip') else target) as binary, io.TextIOWrapper(binary, encoding='utf-8', newline='') as file:
+            for i, df in enumerate(iter_portfolio(n_rows, seed)):
+                df.to_csv(file, sep=';', index=False, header=i == 0)
+    return None
+
+# %%
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write a synthetic portfolio with the schema of the French MTPL data')
+    parser.add_argument('--rows', type=int, default=678_013, help='number of policies (default: as freMTPL2)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=os.path.join('data', 'french_mtpl.zip'), help='.zip or .csv file')
+    args = parser.parse_args()
+    save_portfolio(args.output, args.rows, args.seed)
+    print(f'Synthetic portfolio saved: {args.rows} policies to {args.output}')
@@ -0,0 +1,39 @@
+#%% shared fixtures: a small synthetic portfolio and quickly trained models
+import os
+import sys
+import numpy as np
+import pytest
+from catboost import CatBoostRegressor
+
+# the tests import the repository modules (steps, synthetic, ...) from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import synthetic
+from steps.train import Trainer
+
+targets = {'frequency': 'ClaimNb', 'severity': 'severity'}
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # CatBoost writes its training logs (catboost_info) to the working directory
+    monkeypatch.chdir(tmp_path)
+
+@pytest.fixture(scope='session')
+def portfolio():
+    df = synthetic.generate_portfolio(4000, seed=1)
+    return df.assign(log_exposure=np.log(df['Exposure']),
+                     severity=df['claims_cost'].div(df['ClaimNb']).where(df['ClaimNb'] > 0, 0))
+
+def make_trainer(portfolio, model_type: str, **kwargs) -> Trainer:
+    train, valid = portfolio.iloc[:3000], portfolio.iloc[3000:]
+    return Trainer(target=targets[model_type], train_data=train, val_data=valid, test_data=valid, model_type=model_type, **kwargs)
+
+@pytest.fixture(scope='session')
+def models(portfolio):
+    # frequency with the log exposure baseline, severity weighted by the claim counts
+    models = {}
+    for model_type in targets:
+        trainer = make_trainer(portfolio, model_type)
+        model = CatBoostRegressor(loss_function='Poisson' if model_type == 'frequency' else 'RMSE', iterations=60, depth=4,
+                                  thread_count=1, verbose=False, random_seed=0, allow_writing_files=False)
+        models[model_type] = model.fit(trainer._build_pool(trainer.train_data))
+    return models
@@ -0,0 +1,48 @@
+#%% CompiledModel.predict against CatBoostRegressor.predict
+import numpy as np
+import pytest
+from catboost import CatBoostRegressor, Pool, sum_models
+from steps.compiled import CompiledModel, export_model
+from conftest import make_trainer
+
+losses = {'frequency': 'Poisson', 'severity': 'RMSE'}
+
+def fit(pool: Pool, model_type: str, one_hot_max_size: int = 2, **kwargs) -> CatBoostRegressor:
+    # one_hot_max_size 2: VehGas is one-hot encoded, the other categorical factors go through CTRs
+    model = CatBoostRegressor(loss_function=losses[model_type], iterations=150, depth=4, one_hot_max_size=one_hot_max_size,
+                              thread_count=1, verbose=False, random_seed=0, allow_writing_files=False, **kwargs)
+    return model.fit(pool)
+
+def check(model: CatBoostRegressor, trainer, tmp_path):
+    path = str(tmp_path / 'model.npz')
+    export_model(model, trainer.train_data.filter(items=trainer.numeric_features + trainer.cat_features), trainer.cat_features, path)
+    compiled = CompiledModel(path)
+    assert len(compiled.ctr_type), 'the trees use no CTR'
+    data = trainer.val_data
+    baseline = data['log_exposure'].to_numpy() if trainer.model_type == 'frequency' else None
+    predictions = compiled.predict(data[trainer.numeric_features].to_numpy(), data[trainer.cat_features].to_numpy(), baseline)
+    np.testing.assert_allclose(predictions, model.predict(trainer._build_pool(data)), rtol=1e-10)
+
+@pytest.mark.parametrize('model_type', ['frequency', 'severity'])
+@pytest.mark.parametrize('one_hot_max_size', [2, 6])
+def test_ctrs(portfolio, model_type, one_hot_max_size, tmp_path):
+    # frequency with the log exposure baseline, severity weighted by the claim counts; with 6, Area is
+    # one-hot encoded too, on values whose hashes the dump writes as negative integers
+    trainer = make_trainer(portfolio, model_type)
+    model = fit(trainer._build_pool(trainer.train_data), model_type, one_hot_max_size)
+    check(model, trainer, tmp_path)
+
+def test_summed(portfolio, tmp_path):
+    # warm start as Trainer.train_incremental: the second model boosts from the raw predictions of the first
+    trainer = make_trainer(portfolio, 'frequency')
+    pool = trainer._build_pool(trainer.train_data)
+    first = fit(pool, 'frequency')
+    pool.set_baseline(first.predict(pool, prediction_type='RawFormulaVal'))
+    second = fit(pool, 'frequency', learning_rate=0.05)
+    check(sum_models([first, second]), trainer, tmp_path)
+
+@pytest.mark.parametrize('model_type', ['frequency', 'severity'])
+def test_quantized_pool(portfolio, model_type, tmp_path):
+    trainer = make_trainer(portfolio, model_type, pool_cache_dir=str(tmp_path / 'pools'))
+    train_pool, _ = trainer._quantized_pools(border_count=32)
+    check(fit(train_pool, model_type), trainer, tmp_path)
@@ -0,0 +1,33 @@
+#%% streaming evaluation tables
+import numpy as np
+import pytest
+from steps.evaluate import EvaluationAccumulator, prepare_chunk
+
+@pytest.fixture(scope='module')
+def book(portfolio):
+    # raw rows as read from data/*.csv, and predictions in a narrow range (within 5% of each other)
+    rng = np.random.default_rng(0)
+    chunk = portfolio.drop(columns=['log_exposure', 'severity'])
+    return chunk, 1700 * (1 + 0.05 * rng.random(len(chunk)))
+
+@pytest.mark.parametrize('model_type', ['frequency', 'severity'])
+def test_equal_weight_deciles(book, model_type):
+    raw, predicted = book
+    chunk = prepare_chunk(raw, model_type)
+    predicted = predicted * (chunk['Exposure'].to_numpy() / 1e4 if model_type == 'frequency' else 1)
+    deciles = EvaluationAccumulator(model_type).add(chunk, predicted).deciles()
+    assert list(deciles.index) == list(range(1, 11))
+    np.testing.assert_allclose(deciles['weight'], deciles['weight'].sum() / 10)
+    assert deciles['predicted_rate'].is_monotonic_increasing
+    assert (deciles['rate_from'].to_numpy()[1:] >= deciles['rate_to'].to_numpy()[:-1] * (1 - 1e-3)).all()
+
+def test_merge(book):
+    # chunks accumulated separately and merged give the tables of a single pass
+    raw, predicted = book
+    chunk = prepare_chunk(raw, 'severity')
+    whole = EvaluationAccumulator('severity').add(chunk, predicted)
+    merged = EvaluationAccumulator('severity').add(chunk.iloc[:1500], predicted[:1500])
+    merged.merge(EvaluationAccumulator('severity').add(chunk.iloc[1500:], predicted[1500:]))
+    assert merged.summary() == pytest.approx(whole.summary())
+    for name, table in whole.tables().items():
+        np.testing.assert_allclose(merged.tables()[name].to_numpy(dtype=float), table.to_numpy(dtype=float), rtol=1e-9)
@@ -0,0 +1,14 @@
+#%% parquet cache of the csv splits
+import os
+from steps import ingest
+from steps.ingest import Ingestion
+
+def test_stale_cache_removed_meanwhile(portfolio, monkeypatch):
+    # the other model's pipeline lists the same stale parquet copy and removes it first
+    os.makedirs('data/cache')
+    portfolio.drop(columns=['log_exposure', 'severity']).to_csv('data/train.csv', sep=';', index=False)
+    listdir = os.listdir
+    monkeypatch.setattr(ingest.os, 'listdir', lambda path: listdir(path) + ['train-0-0.parquet'])
+    df = Ingestion()._read_split('train.csv')
+    assert len(df) == len(portfolio)
+    assert [name for name in listdir('data/cache') if name.endswith('.parquet')] == [os.path.basename(Ingestion()._cache_path('train.csv'))]
@@ -0,0 +1,28 @@
+#%% model reloads across worker processes
+import time
+import yaml
+from steps.models import ModelStore
+
+def test_publish_reaches_other_stores(models, tmp_path):
+    # two stores on the same config and generation file stand for two gunicorn workers
+    paths = {model_type: str(tmp_path / f'{model_type}.cbm') for model_type in models}
+    for model_type, model in models.items():
+        model.save_model(paths[model_type])
+    with open(tmp_path / 'config.yml', 'w') as file:
+        yaml.safe_dump({'models': paths}, file)
+    generation_path = str(tmp_path / '.models.generation')
+    publisher, worker = (ModelStore(str(tmp_path / 'config.yml'), generation_path) for _ in range(2))
+    publisher.load()
+    worker.load()
+    worker.watch(interval_s=0.05, files=False)
+    try:
+        result = publisher.publish()
+        for _ in range(100):
+            if worker.generation == result['generation']:
+                break
+            time.sleep(0.05)
+    finally:
+        worker.stop()
+    assert worker.generation == result['generation'] == publisher.generation
+    assert worker.reloads == {'ok': 1, 'failed': 0}
+    assert publisher.reloads == {'ok': 1, 'failed': 0}
@@ -0,0 +1,48 @@
+#%% predict_fast against predict on the pool built by create_pool
+import numpy as np
+import pytest
+from steps.predict import Predictor
+
+@pytest.fixture(params=['frequency', 'severity'])
+def case(request, models, portfolio):
+    model_type = request.param
+    predictor = Predictor(models[model_type], model_type)
+    # float64 exposures, as received by the API (the float32 column would round the log exposure)
+    rows = portfolio.iloc[:40].filter(items=predictor.numeric_features + predictor.cat_features + ['Exposure']).astype({'Exposure': np.float64})
+    return predictor, rows
+
+def reference(predictor: Predictor, rows, exposure: bool) -> np.ndarray:
+    # unit exposure when the records carry none, as predict_fast
+    data = rows.assign(Exposure=rows['Exposure'] if exposure else 1.0)
+    data = data.assign(log_exposure=np.log(data['Exposure']), ClaimNb=1)
+    return predictor.model.predict(predictor.create_pool(data))
+
+@pytest.mark.parametrize('exposure', [False, True])
+def test_dicts(case, exposure):
+    predictor, rows = case
+    records = rows.to_dict('records') if exposure else rows.drop(columns='Exposure').to_dict('records')
+    expected = reference(predictor, rows, exposure)
+    np.testing.assert_allclose(predictor.predict_fast(records), expected, rtol=1e-12)
+    np.testing.assert_allclose(predictor.predict_fast(records[0]), expected[:1], rtol=1e-12)
+
+def test_tuples(case):
+    # tuples carry the rating factors only, numeric block first
+    predictor, rows = case
+    records = list(rows[predictor.numeric_features + predictor.cat_features].itertuples(index=False, name=None))
+    expected = reference(predictor, rows, exposure=False)
+    np.testing.assert_allclose(predictor.predict_fast(records), expected, rtol=1e-12)
+    np.testing.assert_allclose(predictor.predict_fast(records[0]), expected[:1], rtol=1e-12)
+
+@pytest.mark.parametrize('exposure', [False, True])
+def test_record_array(case, exposure):
+    predictor, rows = case
+    records = (rows if exposure else rows.drop(columns='Exposure')).to_records(index=False)
+    np.testing.assert_allclose(predictor.predict_fast(records), reference(predictor, rows, exposure), rtol=1e-12)
+
+def test_cache_key_exposure(models, portfolio):
+    # the exposure splits frequency entries only
+    row = portfolio.iloc[0][['VehPower', 'VehAge', 'DrivAge', 'Density', 'BonusMalus', 'VehBrand', 'VehGas', 'Region', 'Area']].to_dict()
+    frequency = Predictor(models['frequency'], 'frequency')
+    severity = Predictor(models['severity'], 'severity')
+    assert frequency._cache_key(dict(row, Exposure=0.5)) != frequency._cache_key(dict(row, Exposure=1.0))
+    assert severity._cache_key(dict(row, Exposure=0.5)) == severity._cache_key(dict(row, Exposure=1.0))
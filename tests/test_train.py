@@ -0,0 +1,25 @@
+#%% incremental refreshes of a trained model
+import numpy as np
+import pytest
+from catboost import CatBoostRegressor
+from conftest import make_trainer
+
+@pytest.mark.parametrize('model_type', ['frequency', 'severity'])
+def test_two_incremental_refreshes(portfolio, model_type, tmp_path):
+    # the second refresh warm starts from a model saved by the first (a sum of models for frequency)
+    path = str(tmp_path / 'model.cbm')
+    params = {'learning_rate': 0.2, 'depth': 3}
+    trainer = make_trainer(portfolio, model_type, thread_count=1, params=params)
+    trainer.train_model().save_model(path)
+    tree_count = CatBoostRegressor().load_model(path).tree_count_
+    for _ in range(2):
+        model = make_trainer(portfolio, model_type, thread_count=1, params=params).train_incremental(path, iterations=20)
+        model.save_model(path)
+        model = CatBoostRegressor().load_model(path)
+        assert model.tree_count_ > tree_count
+        assert float(model.get_metadata()['learning_rate']) == pytest.approx(params['learning_rate'])
+        # the new trees are grown with the tuned parameters (a tree may stop short of the depth)
+        assert max(model.get_tree_leaf_counts()) == 2 ** params['depth']
+        tree_count = model.tree_count_
+    _, _, test_pool = trainer.create_pools()
+    assert np.all(np.isfinite(model.predict(test_pool)))